@@ -11,7 +11,18 @@ def main(args):
     if module == "aggregator":
         from hyperstats.aggregator import main
     elif module == "httpd":
+        # Must be patched before bottle is imported
+        from gevent import monkey
+        monkey.patch_all()
         from hyperstats.httpd import main
+    elif module == "bench":
+        from hyperstats.bench import main
+    elif module == "fakegen":
+        from hyperstats.fakegen import main
+    elif module == "export":
+        from hyperstats.export import main
+    elif module == "backfill":
+        from hyperstats.backfill import main
     if main is None:
         print "Error: unknown module '%s'" % (module,)
         return 2
@@ -30,12 +30,19 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 __all__ = ['AggregatorDaemon', 'main']
 
 from redis import StrictRedis
-from hyperstats.common import unixtime, QueueDaemon, make_facet_id, split_facet, all_permutations
+from hyperstats.common import unixtime, QueueDaemon, make_facet_id, split_facet, all_permutations, shard_facet, SHARDS_VALUE
+from hyperstats.sketch import hll_key, merge_hll, dd_key, DDSketch, topk_key, load_topk, TOPK_SIZE
+from hyperstats.guard import CardinalityGuard, load_limits
+from hyperstats.config import load_config
 from os import urandom
-import marshal, hyperclient, logging
+from random import randrange
+import marshal, hyperclient, logging, argparse
 
 LOG = logging.getLogger(__name__)
 
+# Set of the IDs of hot facets, shared by all aggregators
+HOT_KEY = '$hs.hot'
+
 class ReliableHyperClient(object):
     """
     'Reliable' version of the HyperDex client that ignores interrupts when
@@ -85,36 +92,123 @@ class AggregatorDaemon(QueueDaemon):
     It aggregates all the values, buffering them for a period of time, then
     inserts into HyperDex.
     """
-    def __init__(self, rdb, hdex):
+    # Number of children kept in each top-K index
+    topk_size = TOPK_SIZE
+    # Facets updated by this fraction of records are hot, their counters are
+    # split across `hot_shards` sub-keys. One in `hot_sample` records is
+    # counted, hot facets are looked for every `hot_window` counted records.
+    hot_fraction = 0.05
+    hot_shards = 8
+    hot_sample = 10
+    hot_window = 1000
+
+    def __init__(self, rdb, hdex, guard=None, topk=()):
+        """
+        :param guard: Optional CardinalityGuard applied to every record
+        :param topk: Names of the values to maintain top-K indexes of
+        """
         super(AggregatorDaemon, self).__init__(rdb)
         assert hdex is not None
         self._hdex = hdex
+        self._guard = guard
+        self.topk = set(topk)
         self._last_sync = unixtime()
+        self._ddsketch = DDSketch()
+        self._hot = set(self.redis.smembers(HOT_KEY))
+        self._records = 0
+        self._sampled = 0
+        self._facet_counts = {}
 
     def aggregate_in_redis(self, record):
         """
         Aggregate the values for all permutations of the records facets.
         """
+        distinct = record.get('distinct', [])
+        # The bins are the same for every facet, only work them out once
+        bins = [(name, [self._ddsketch.bin_name(number) for number in numbers])
+                for name, numbers in record.get('samples', [])]
+        self._records += 1
+        sampled = self._records % self.hot_sample == 0
         with self.redis.pipeline(True) as pipe:
             for facet in all_permutations(record['facets']):   
                 facet = split_facet(facet)                       
-                self.insert_to_redis(pipe, facet, record['values'])                          
+                if sampled:
+                    self.count_facet(facet)
+                if facet['id'] in self._hot:
+                    facet = shard_facet(facet, randrange(self.hot_shards))
+                self.insert_to_redis(pipe, facet, record['values'], distinct, bins)
             pipe.execute()
+        if sampled:
+            self._sampled += 1
+            if self._sampled >= self.hot_window:
+                self.find_hot_facets()
         return True
 
-    def insert_to_hyperdex(self, facet, values):
+    def count_facet(self, facet):
+        counted = self._facet_counts.get(facet['id'])
+        if counted is None:
+            self._facet_counts[facet['id']] = [1, facet]
+        else:
+            counted[0] += 1
+
+    def find_hot_facets(self):
+        """
+        Start sharding the facets which were updated by enough of the
+        counted records.
+        """
+        threshold = self.hot_fraction * self._sampled
+        for facet_id, (count, facet) in self._facet_counts.items():
+            if count >= threshold and facet_id not in self._hot:
+                self.mark_hot(facet)
+        self._facet_counts = {}
+        self._sampled = 0
+
+    def mark_hot(self, facet):
+        """
+        Readers know to sum a facet's shards by the reserved value in its
+        record. It's written before the facet is added to the hot set, so
+        there are never shards without it. If writing it fails the facet
+        isn't sharded, and it's tried again when the facet is next found hot.
+        """
+        try:
+            record = self._hdex.get('stats', facet['id'])
+            self.incr_stats('hyperdex.ops')
+            self.incr_stats('hyperdex.ops.get')
+            if record is None or SHARDS_VALUE not in record['values']:
+                self.insert_to_hyperdex(facet, {SHARDS_VALUE: self.hot_shards})
+            self.incr_stats('redis.ops')
+            self.incr_stats('redis.ops.sadd')
+            if self.redis.sadd(HOT_KEY, facet['id']):
+                LOG.info("Facet '%s' is hot, splitting it into %d shards",
+                         facet['id'], self.hot_shards)
+        except Exception:
+            LOG.error("Failed to mark facet '%s' as hot", facet['id'], exc_info=True)
+            return
+        self._hot.add(facet['id'])
+
+    def insert_to_hyperdex(self, facet, values, sketches=None, quantiles=None):
         """
         Update counters for the facet for the given record.
+
+        :param sketches: Dictionary of HyperLogLog sketches to merge into the
+                         distinct counts of the facet
+        :param quantiles: Dictionary of DDSketch to merge into the quantile
+                          sketches of the facet
         """
         values = {key: int(value) for key, value in values.items()}
+        sketches = sketches or {}
+        quantiles = quantiles or {}
         put_ok = self._hdex.put_if_not_exist('stats', facet['id'], {
             'facet_parent_id': facet['parent_id'],
             'facet': facet['child'],
             'last_id': make_facet_id([urandom(4), facet['id']]),
-            'values': values
+            'values': values,
+            'distinct': sketches,
+            'quantiles': {name: sketch.dumps() for name, sketch in quantiles.items()}
         })
         self.incr_stats('hyperdex.ops')
         self.incr_stats('hyperdex.ops.put_if_not_exist')
+        totals = values
 
         # Record already exists, we need to update it
         while put_ok == False:
@@ -126,63 +220,237 @@ class AggregatorDaemon(QueueDaemon):
                 # XXX: avoid infinite loop
                 continue            
 
-            new_values = {}
+            new_values = dict(server_record['values'])
             for value_name, value in values.items():
-                new_values[value_name] = int(server_record['values'].get(value_name, 0) + value)
+                new_values[value_name] = int(new_values.get(value_name, 0) + value)
+            totals = new_values
+
+            new_distinct = dict(server_record.get('distinct') or {})
+            for name, sketch in sketches.items():
+                new_distinct[name] = merge_hll(self.redis, [new_distinct.get(name), sketch])
+                self.incr_stats('redis.ops.pfmerge')
+
+            new_quantiles = dict(server_record.get('quantiles') or {})
+            for name, sketch in quantiles.items():
+                if name in new_quantiles:
+                    stored = DDSketch.loads(new_quantiles[name])
+                    stored.merge(sketch)
+                    sketch = stored
+                new_quantiles[name] = sketch.dumps()
 
             new_id = make_facet_id([urandom(4), facet['id'], server_record['last_id']])
+            update = dict(last_id=new_id, values=new_values)
+            if sketches:
+                update['distinct'] = new_distinct
+            if quantiles:
+                update['quantiles'] = new_quantiles
             put_ok = self._hdex.cond_put('stats', facet['id'],
                                dict(last_id=server_record['last_id']),
-                               dict(last_id=new_id,
-                                    values=new_values))
+                               update)
             self.incr_stats('hyperdex.ops')
             self.incr_stats('hyperdex.ops.cond_put')
+        # The index is only a cache, the write has already succeeded
+        try:
+            if 'shard_of' in facet:
+                # The totals are only the shard's, add the changes instead
+                self.update_topk(facet['shard_of'], values, increment=True)
+            elif SHARDS_VALUE in totals:
+                # The shards have added theirs to the score of a hot facet
+                self.update_topk(facet, values, increment=True)
+            else:
+                self.update_topk(facet, totals)
+        except Exception:
+            LOG.warning("Failed to update top-K index for '%s'", facet['id'], exc_info=True)
         return True
 
-    def insert_to_redis(self, pipe, facet, values):
+    def update_topk(self, facet, totals, increment=False):
+        """
+        Maintain the index of the children of the facet's parent with the
+        highest totals for each of the `topk` values. Scores are the absolute totals, so a
+        child which was trimmed from the index comes back at its next sync
+        once its total is high enough again.
+
+        :param increment: Add to the scores, for hot facets and their shards.
+                          A trimmed hot facet comes back with only the changes.
+        """
+        totals = {name: total for name, total in totals.items()
+                  if name in self.topk}
+        if not totals:
+            return
+        with self.redis.pipeline(False) as pipe:
+            for name, total in totals.items():
+                key = topk_key(facet['parent_id'], name)
+                if increment:
+                    pipe.zincrby(key, total, facet['child'])
+                else:
+                    pipe.zadd(key, {facet['child']: total})
+                pipe.zremrangebyrank(key, 0, -(self.topk_size + 1))
+            pipe.execute()
+        self.incr_stats('redis.ops.zincrby' if increment else 'redis.ops.zadd', len(totals))
+        self.incr_stats('redis.ops.zremrangebyrank', len(totals))
+        self.incr_stats('redis.ops', 2 * len(totals))
+
+    def insert_to_redis(self, pipe, facet, values, distinct=(), bins=()):
         hincr_ops = 0
         for key, value in values:            
             hincr_ops += 1
             pipe.hincrby(facet['id'], key, value)
+        # Distinct items go into a HyperLogLog per name, the hash remembers
+        # which names have one so they're found when syncing
+        for name, items in distinct:
+            pipe.pfadd(hll_key(facet['id'], name), *items)
+            pipe.hsetnx(facet['id'], '$hll.' + name, 1)
+        # Samples are counted in the bins of a quantile sketch
+        for name, names in bins:
+            for bin_name in names:
+                hincr_ops += 1
+                pipe.hincrby(dd_key(facet['id'], name), bin_name, 1)
+            pipe.hsetnx(facet['id'], '$dd.' + name, 1)
         pipe.hsetnx(facet['id'], '$hs.facet', marshal.dumps(facet))
         pipe.sadd('keys', facet['id'])
 
+        hsetnx_ops = 1 + len(distinct) + len(bins)
         self.incr_stats('redis.ops.hincrby', hincr_ops)
-        self.incr_stats('redis.ops.hsetnx', 2)
+        self.incr_stats('redis.ops.pfadd', len(distinct))
+        self.incr_stats('redis.ops.hsetnx', hsetnx_ops)
         self.incr_stats('redis.ops.sadd')
-        self.incr_stats('redis.ops', 3 + hincr_ops)
+        self.incr_stats('redis.ops', 1 + hsetnx_ops + hincr_ops + len(distinct))
+
+    def take_from_redis(self, member):
+        """
+        Take the buffered counters and sketches of a facet from Redis and
+        reset them atomically, updates which arrive afterwards re-create them.
+
+        :returns: Tuple of (facet, values, sketches, quantiles), or None
+        """
+        with self.redis.pipeline(True) as pipe:
+            pipe.hgetall(member)
+            pipe.delete(member)
+            pipe.srem('keys', member)
+            values = pipe.execute()[0]
+        self.incr_stats('redis.ops', 3)
+        self.incr_stats('redis.ops.hgetall')
+        self.incr_stats('redis.ops.delete')
+        self.incr_stats('redis.ops.srem')
+        if '$hs.facet' not in values:
+            return None
+        facet = marshal.loads(values.pop('$hs.facet'))
+
+        hll_names = [key[5:] for key in values.keys() if key.startswith('$hll.')]
+        dd_names = [key[4:] for key in values.keys() if key.startswith('$dd.')]
+        sketches = {}
+        quantiles = {}
+        if hll_names or dd_names:
+            with self.redis.pipeline(True) as pipe:
+                for name in hll_names:
+                    del values['$hll.' + name]
+                    pipe.get(hll_key(member, name))
+                    pipe.delete(hll_key(member, name))
+                for name in dd_names:
+                    del values['$dd.' + name]
+                    pipe.hgetall(dd_key(member, name))
+                    pipe.delete(dd_key(member, name))
+                results = pipe.execute()
+            self.incr_stats('redis.ops', 2 * (len(hll_names) + len(dd_names)))
+            for name, sketch in zip(hll_names, results[0::2]):
+                if sketch is not None:
+                    sketches[name] = sketch
+            for name, bins in zip(dd_names, results[2 * len(hll_names)::2]):
+                if bins:
+                    quantiles[name] = DDSketch()
+                    quantiles[name].add_bins(bins)
+        return facet, values, sketches, quantiles
+
+    def restore_to_redis(self, facet, values, sketches, quantiles):
+        """
+        Put counters taken by take_from_redis back, adding them to any
+        updates which arrived since, so they're synced again later.
+        """
+        temp_keys = []
+        with self.redis.pipeline(True) as pipe:
+            for name, value in values.items():
+                pipe.hincrby(facet['id'], name, value)
+            for name, sketch in sketches.items():
+                temp_key = '$hs.tmp.' + make_facet_id([urandom(4), facet['id']])
+                temp_keys.append(temp_key)
+                pipe.set(temp_key, sketch)
+                pipe.pfmerge(hll_key(facet['id'], name), temp_key)
+                pipe.hsetnx(facet['id'], '$hll.' + name, 1)
+            for name, sketch in quantiles.items():
+                for bin_name, count in sketch.bins().items():
+                    pipe.hincrby(dd_key(facet['id'], name), bin_name, count)
+                pipe.hsetnx(facet['id'], '$dd.' + name, 1)
+            if temp_keys:
+                pipe.delete(*temp_keys)
+            pipe.hsetnx(facet['id'], '$hs.facet', marshal.dumps(facet))
+            pipe.sadd('keys', facet['id'])
+            pipe.execute()
+        self.incr_stats('restored')
+
+    def sync_redis(self, force=False):
+        """
+        Flush the counters buffered in Redis into HyperDex.
 
-    def sync_redis(self):
+        :param force: Sync now, regardless of the time or number of entries
+        """
         # Sync every 5 minutes, or when 5k entries exist
-        need_to_sync = self.redis.scard('keys') > 5000
+        need_to_sync = force or self.redis.scard('keys') > 5000
         if not need_to_sync:
             if self._last_sync is None:
                 need_to_sync = True
             else:
                 need_to_sync = self._last_sync < (unixtime() - (60))
         if need_to_sync:
-            self.incr_stats('redis.ops')
-            self.incr_stats('redis.ops.smembers')
+            # Pick up facets other aggregators found to be hot
+            self._hot.update(self.redis.smembers(HOT_KEY))
+            self.incr_stats('redis.ops', 2)
+            self.incr_stats('redis.ops.smembers', 2)
             for member in self.redis.smembers('keys'):
-                values = self.redis.hgetall(member)
-                self.incr_stats('redis.ops')
-                self.incr_stats('redis.ops.hgetall')
-                facet = marshal.loads(values['$hs.facet'])
-                del values['$hs.facet']
-                self.insert_to_hyperdex(facet, values)
+                taken = self.take_from_redis(member)
+                if taken is None:
+                    continue
+                facet, values, sketches, quantiles = taken
+                try:
+                    self.insert_to_hyperdex(facet, values, sketches, quantiles)
+                except Exception:
+                    # Try again at the next sync, rather than losing them
+                    LOG.error("Failed to sync '%s' to HyperDex", member, exc_info=True)
+                    self.restore_to_redis(facet, values, sketches, quantiles)
+                    break
                 self.show_status()
                 if self.is_stopping():
                     break
+            self._last_sync = unixtime()
 
     def process(self, record):
+        if self._guard is not None:
+            facets = record['facets']
+            record = self._guard.check(record)
+            if record is None:
+                self.incr_stats('guard.dropped')
+                return True
+            if record['facets'] != facets:
+                self.incr_stats('guard.other')
         result = self.aggregate_in_redis(record)
         self.sync_redis()
         return result
 
 def main(args):
-    rdb = StrictRedis()
-    hdex = ReliableHyperClient('10.0.3.23', 10502)
-    AggregatorDaemon(rdb, hdex).run('aggqueue')
+    parser = argparse.ArgumentParser(prog='python -mhyperstats aggregator')
+    parser.add_argument('--config',
+                        help='Config file with connection settings, cardinality limits'
+                             ' and top-K indexes,'
+                             ' default $HYPERSTATS_CONFIG')
+    opts = parser.parse_args(args)
+
+    config = load_config(opts.config)
+    rdb = StrictRedis(host=config.redis_host, port=config.redis_port,
+                      db=config.redis_db)
+    hdex = ReliableHyperClient(config.hyperdex_host, config.hyperdex_port)
+    limits = load_limits(config)
+    guard = CardinalityGuard(rdb, limits) if limits else None
+    topk = load_topk(config).get('stats', ())
+    AggregatorDaemon(rdb, hdex, guard, topk).run('aggqueue')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,298 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['Backfill', 'aggregate_records', 'merge_deltas', 'main']
+
+from redis import StrictRedis
+from hyperstats.aggregator import AggregatorDaemon, ReliableHyperClient
+from hyperstats.config import load_config
+from hyperstats.common import all_permutations, split_facet, ValidationError, Daemon
+from hyperstats.guard import CardinalityGuard, load_limits
+from hyperstats.schema import load_schemas
+from hyperstats.sketch import make_hlls, merge_hll, load_topk, DDSketch
+from multiprocessing import Pool, cpu_count
+from itertools import islice
+import argparse, logging, json, gzip, signal, os
+
+LOG = logging.getLogger(__name__)
+
+# Bytes of input read by a worker at a time
+CHUNK_SIZE = 8 * 1024 * 1024
+# Distinct counts sketched per round trip to Redis
+SKETCH_BATCH = 1000
+# Sketches of a distinct count kept before merging them
+MERGE_SKETCHES = 16
+
+
+def aggregate_records(records, deltas=None):
+    """
+    Pre-aggregate records into the deltas of every facet they update, the
+    same as AggregatorDaemon.aggregate_in_redis buffers them in Redis.
+
+    Deltas are a dictionary of facet ID to tuples of (facet, values,
+    distinct, bins) where distinct are sets of the items of each name and
+    bins are the quantile sketch bin counts of each name.
+    """
+    if deltas is None:
+        deltas = {}
+    ddsketch = DDSketch()
+    for record in records:
+        bins = [(name, [ddsketch.bin_name(number) for number in numbers])
+                for name, numbers in record.get('samples', [])]
+        for facet in all_permutations(record['facets']):
+            facet = split_facet(facet)
+            delta = deltas.get(facet['id'])
+            if delta is None:
+                delta = deltas[facet['id']] = (facet, {}, {}, {})
+            _, values, distinct, facet_bins = delta
+            for name, value in record['values']:
+                values[name] = values.get(name, 0) + value
+            for name, items in record.get('distinct', []):
+                distinct.setdefault(name, set()).update(items)
+            for name, names in bins:
+                counts = facet_bins.setdefault(name, {})
+                for bin_name in names:
+                    counts[bin_name] = counts.get(bin_name, 0) + 1
+    return deltas
+
+def sketch_distinct(rdb, deltas, batch=SKETCH_BATCH):
+    """
+    Replace the sets of distinct items in the deltas with lists holding a
+    HyperLogLog sketch of them, which is what merge_deltas expects
+    """
+    pending = [(distinct, name) for _, _, distinct, _ in deltas.values() for name in distinct]
+    for start in range(0, len(pending), batch):
+        part = pending[start:start + batch]
+        sketches = make_hlls(rdb, [list(distinct[name]) for distinct, name in part])
+        for (distinct, name), sketch in zip(part, sketches):
+            distinct[name] = [sketch]
+    return deltas
+
+def merge_deltas(deltas, other, rdb=None):
+    """
+    Add the deltas in `other` to `deltas`. The lists of distinct count
+    sketches are joined, and merged with Redis once they get long, the rest
+    are merged when written.
+    """
+    for facet_id, (facet, values, distinct, bins) in other.items():
+        delta = deltas.get(facet_id)
+        if delta is None:
+            deltas[facet_id] = (facet, values, distinct, bins)
+            continue
+        _, merged_values, merged_distinct, merged_bins = delta
+        for name, value in values.items():
+            merged_values[name] = merged_values.get(name, 0) + value
+        for name, sketches in distinct.items():
+            merged_sketches = merged_distinct.setdefault(name, [])
+            merged_sketches.extend(sketches)
+            if rdb is not None and len(merged_sketches) >= MERGE_SKETCHES:
+                merged_sketches[:] = [merge_hll(rdb, merged_sketches)]
+        for name, counts in bins.items():
+            merged_counts = merged_bins.setdefault(name, {})
+            for bin_name, count in counts.items():
+                merged_counts[bin_name] = merged_counts.get(bin_name, 0) + count
+    return deltas
+
+
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def input_chunks(paths, chunk_size=CHUNK_SIZE):
+    """
+    Split the files into (path, start, end) byte ranges, gzipped files
+    can't be seeked in so they're one range each
+    """
+    for path in paths:
+        if path.endswith('.gz'):
+            yield (path, 0, None)
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_size):
+            yield (path, start, start + chunk_size)
+
+def read_lines(path, start, end):
+    """
+    The lines which begin within the byte range, so ranges which split a
+    line between them don't both read it
+    """
+    with open_input(path) as handle:
+        if start > 0:
+            handle.seek(start - 1)
+            handle.readline()
+        while end is None or handle.tell() < end:
+            line = handle.readline()
+            if not line:
+                break
+            yield line
+
+
+class Backfill(object):
+    """
+    Makes records from lines of JSON, as accepted by the httpd sink, then
+    applies the bucket's cardinality limits like the aggregator does.
+    Each worker process has one, and sketches the distinct items of its
+    chunks with Redis.
+    """
+    def __init__(self, rdb, bucket, schema=None, guard=None):
+        from hyperstats.httpd import make_record
+        self.redis = rdb
+        self.bucket = bucket
+        self._make_record = schema.make_record if schema is not None else make_record
+        self._guard = guard
+
+    def records(self, lines, counts):
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = self._make_record(json.loads(line))
+            except (ValueError, ValidationError):
+                counts['invalid'] += 1
+                continue
+            record['bucket'] = self.bucket
+            if self._guard is not None:
+                record = self._guard.check(record)
+                if record is None:
+                    counts['dropped'] += 1
+                    continue
+            counts['records'] += 1
+            yield record
+
+    def aggregate_chunk(self, chunk):
+        counts = {'records': 0, 'invalid': 0, 'dropped': 0}
+        deltas = aggregate_records(self.records(read_lines(*chunk), counts))
+        return sketch_distinct(self.redis, deltas), counts
+
+# The worker process's Backfill
+WORKER = None
+# The writer process's AggregatorDaemon
+WRITER = None
+
+def connect_redis(config):
+    return StrictRedis(host=config.redis_host, port=config.redis_port,
+                       db=config.redis_db)
+
+def init_worker(config, bucket):
+    global WORKER
+    # Only the main process stops on SIGINT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    rdb = connect_redis(config)
+    schema = load_schemas(config).get(bucket)
+    limits = load_limits(config)
+    guard = CardinalityGuard(rdb, limits) if limits else None
+    WORKER = Backfill(rdb, bucket, schema, guard)
+
+def aggregate_chunk(chunk):
+    return WORKER.aggregate_chunk(chunk)
+
+def init_writer(config):
+    global WRITER
+    hdex = ReliableHyperClient(config.hyperdex_host, config.hyperdex_port)
+    WRITER = AggregatorDaemon(connect_redis(config), hdex,
+                              topk=load_topk(config).get('stats', ()))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def write_part(deltas):
+    """
+    Merge the deltas into HyperDex, like the aggregator syncing from Redis
+    """
+    for facet, values, distinct, bins in deltas.values():
+        sketches = {}
+        for name, chunk_sketches in distinct.items():
+            sketches[name] = merge_hll(WRITER.redis, chunk_sketches)
+        quantiles = {}
+        for name, counts in bins.items():
+            quantiles[name] = DDSketch()
+            quantiles[name].add_bins(counts)
+        WRITER.insert_to_hyperdex(facet, values, sketches, quantiles)
+        WRITER.show_status()
+    return len(deltas)
+
+def write_deltas(pool, parts, deltas, pending=None):
+    """
+    Split the deltas between the writer processes once the previous batch
+    has been written, returns the result to wait on. Each facet is in one
+    part, so no two writers update it at the same time.
+    """
+    if pending is not None:
+        pending.get()
+    items = deltas.items()
+    return pool.map_async(write_part, [dict(items[i::parts]) for i in range(parts)], 1)
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='python -mhyperstats backfill')
+    parser.add_argument('--config',
+                        help='Config file with connection settings, schemas and limits,'
+                             ' default $HYPERSTATS_CONFIG')
+    parser.add_argument('--bucket', default='stats',
+                        help='Bucket the records are for, selects the schema and limits')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Worker processes, default one per CPU')
+    parser.add_argument('-w', '--writers', type=int, default=None,
+                        help='Processes writing to HyperDex, default the number of jobs')
+    parser.add_argument('--batch', type=int, default=200000,
+                        help='Facets to merge in memory before writing them')
+    parser.add_argument('files', nargs='+',
+                        help='Files of JSON records, one per line, may be gzipped')
+    opts = parser.parse_args(args)
+
+    config = load_config(opts.config)
+    rdb = connect_redis(config)
+    # Catches SIGINT, to stop after the current batch
+    daemon = Daemon()
+    jobs = opts.jobs or cpu_count()
+    pool = Pool(jobs, init_worker, (config, opts.bucket))
+    # Batches are written while the next is aggregated
+    parts = opts.writers or jobs
+    writers = Pool(parts, init_writer, (config,))
+    pending = None
+    totals = {'records': 0, 'invalid': 0, 'dropped': 0}
+    deltas = {}
+    chunks = input_chunks(opts.files)
+    while not daemon.is_stopping():
+        # A few chunks per worker at a time, so results don't pile up
+        # while writing
+        wave = list(islice(chunks, jobs * 2))
+        if not wave:
+            break
+        for chunk_deltas, counts in pool.imap_unordered(aggregate_chunk, wave):
+            merge_deltas(deltas, chunk_deltas, rdb)
+            for name, count in counts.items():
+                totals[name] += count
+        if len(deltas) >= opts.batch:
+            pending = write_deltas(writers, parts, deltas, pending)
+            deltas = {}
+    pool.close()
+    write_deltas(writers, parts, deltas, pending).get()
+    writers.close()
+    writers.join()
+    if daemon.is_stopping():
+        print "Interrupted, only part of the input was backfilled"
+    print "Backfilled %(records)d records, %(invalid)d invalid, %(dropped)d dropped" % totals
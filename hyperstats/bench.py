@@ -0,0 +1,401 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['MemoryHyperDex', 'main']
+
+from hyperstats.aggregator import AggregatorDaemon
+from hyperstats.connection import Connections
+from hyperstats.common import all_permutations, split_facet, unixtime
+from hyperstats.fakegen import random_record, random_id
+from hyperstats.schema import BucketSchema
+from StringIO import StringIO
+from timeit import default_timer
+import argparse, random, json, sys, platform, logging
+
+LOG = logging.getLogger(__name__)
+
+BENCHMARKS = ['all_permutations', 'split_facet', 'sanitized_facets',
+              'make_record', 'schema_make_record', 'aggregate_in_redis', 'sync_redis',
+              'get_values', 'find_values', 'aggregate_range', 'end_to_end']
+
+
+class MemoryHyperDex(object):
+    """
+    In-memory stand-in for the HyperDex client, implementing the subset of
+    operations which the aggregator and httpd use. Predicates may be plain
+    values for equality, or objects with `lower` and/or `upper` attributes
+    like hyperclient.GreaterEqual, LessEqual and Range.
+
+    Like the `stats` space subspace, searches on `facet_parent_id` are indexed.
+    """
+    def __init__(self):
+        self._spaces = {}
+        self._parents = {}
+
+    def _space(self, space):
+        return self._spaces.setdefault(space, {})
+
+    def get(self, space, key):
+        record = self._space(space).get(key)
+        if record is None:
+            return None
+        return _copy_record(record)
+
+    def put(self, space, key, value):
+        record = self._space(space).setdefault(key, {})
+        record.update(_copy_record(value))
+        if 'facet_parent_id' in record:
+            parents = self._parents.setdefault(space, {})
+            parents.setdefault(record['facet_parent_id'], set()).add(key)
+        return True
+
+    def put_if_not_exist(self, space, key, value):
+        if key in self._space(space):
+            return False
+        return self.put(space, key, value)
+
+    def cond_put(self, space, key, condition, value):
+        record = self._space(space).get(key)
+        if record is None or not _matches(record, condition):
+            return False
+        record.update(_copy_record(value))
+        return True
+
+    def search(self, space, predicate):
+        records = self._space(space)
+        parent_id = predicate.get('facet_parent_id')
+        if isinstance(parent_id, basestring):
+            keys = self._parents.get(space, {}).get(parent_id, ())
+        else:
+            keys = records.keys()
+        for key in keys:
+            result = _copy_record(records[key])
+            result['id'] = key
+            if _matches(result, predicate):
+                yield result
+
+    def sorted_search(self, space, predicate, sortby, limit, maxmin):
+        results = sorted(self.search(space, predicate),
+                         key=lambda result: result[sortby],
+                         reverse=(maxmin == 'max'))
+        return results[:limit]
+
+
+def _copy_record(record):
+    return {key: (dict(value) if type(value) == dict else value)
+            for key, value in record.items()}
+
+def _matches(record, predicate):
+    for name, check in predicate.items():
+        value = record.get(name)
+        if isinstance(check, (basestring, int, long, float)):
+            if value != check:
+                return False
+            continue
+        lower = getattr(check, 'lower', None)
+        upper = getattr(check, 'upper', None)
+        if value is None:
+            return False
+        if lower is not None and value < lower:
+            return False
+        if upper is not None and value > upper:
+            return False
+    return True
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def _summarize(timings, operations, total):
+    """
+    Summarize the per-call timings (in seconds) of a benchmark
+    """
+    ordered = sorted(timings)
+    return {
+        'calls': len(timings),
+        'ops': operations,
+        'seconds': total,
+        'ops_per_sec': (operations / total) if total > 0 else 0.0,
+        'mean_us': (total / len(timings)) * 1e6 if timings else 0.0,
+        'p50_us': _percentile(ordered, 0.50) * 1e6,
+        'p99_us': _percentile(ordered, 0.99) * 1e6,
+    }
+
+def measure(func, inputs):
+    """
+    Call `func` once for each of the inputs, timing every call.
+
+    If `func` returns an integer it is used as the number of operations the
+    call performed, otherwise each call counts as one operation.
+    """
+    timings = []
+    operations = 0
+    for item in inputs:
+        begin = default_timer()
+        result = func(item)
+        timings.append(default_timer() - begin)
+        operations += result if type(result) in [int, long] else 1
+    return _summarize(timings, operations, sum(timings))
+
+
+class QuietAggregator(AggregatorDaemon):
+    """
+    Status lines would otherwise be mixed into the JSON output
+    """
+    def show_status(self):
+        pass
+
+
+class BenchContext(object):
+    """
+    Shared state for a benchmark run: the Redis connection, HyperDex stand-in
+    and a fixed set of randomly generated input records.
+    """
+    def __init__(self, rdb, count, seed):
+        from hyperstats import httpd
+        self.redis = rdb
+        self.count = count
+        self.httpd = httpd
+        self.app = httpd.bottle.default_app()
+        random.seed(seed)
+        self.inputs = []
+        for _ in range(count):
+            facets, values = random_record()
+            self.inputs.append({'id': random_id(), 'facets': facets,
+                                'values': values})
+        self.records = [httpd.make_record(data) for data in self.inputs]
+        self.reset()
+
+    def reset(self):
+        """
+        Start with empty storage, both Redis and HyperDex
+        """
+        self.redis.flushdb()
+        self.hdex = MemoryHyperDex()
+        self.httpd.DB = Connections(redis=self.redis, hyperdex=self.hdex)
+        self.aggregator = QuietAggregator(self.redis, self.hdex)
+
+    def load(self):
+        """
+        Aggregate and sync all records, so queries have data to work with
+        """
+        self.reset()
+        for record in self.records:
+            self.aggregator.aggregate_in_redis(record)
+        self.aggregator.sync_redis(force=True)
+
+    def call(self, method, path, data):
+        """
+        Perform a HTTP request against the httpd WSGI application without
+        going through a socket, returns the decoded JSON response.
+        """
+        body = json.dumps(data)
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '8080',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.url_scheme': 'http',
+            'wsgi.version': (1, 0),
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        status = []
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+        response = ''.join(self.app(environ, start_response))
+        if not status[0].startswith('200'):
+            raise RuntimeError("%s %s failed: %s" % (method, path, status[0]))
+        return json.loads(response)
+
+
+def bench_all_permutations(ctx):
+    return measure(lambda record: len(all_permutations(record['facets'])),
+                   ctx.records)
+
+def bench_split_facet(ctx):
+    facets = []
+    for record in ctx.records:
+        facets += all_permutations(record['facets'])
+    return measure(split_facet, facets)
+
+def bench_sanitized_facets(ctx):
+    return measure(ctx.httpd.sanitized_facets,
+                   [data['facets'] for data in ctx.inputs])
+
+def bench_make_record(ctx):
+    return measure(ctx.httpd.make_record, ctx.inputs)
+
+def bench_schema_make_record(ctx):
+    schema = BucketSchema('stats', {'time': 4, 'device': 2, 'content': 3},
+                          {'datapoints': 'int', 'view_duration': 'int',
+                           'revenue': 'int'})
+    return measure(schema.make_record, ctx.inputs)
+
+def bench_aggregate_in_redis(ctx):
+    ctx.reset()
+    return measure(ctx.aggregator.aggregate_in_redis, ctx.records)
+
+def bench_sync_redis(ctx):
+    ctx.reset()
+    for record in ctx.records:
+        ctx.aggregator.aggregate_in_redis(record)
+    def sync(_):
+        count = ctx.redis.scard('keys')
+        ctx.aggregator.sync_redis(force=True)
+        return count
+    return measure(sync, [None])
+
+def bench_get_values(ctx):
+    ctx.load()
+    queries = [{'q': data['facets']} for data in ctx.inputs]
+    return measure(lambda query: ctx.call('POST', '/stats/get-values', query),
+                   queries)
+
+def bench_find_values(ctx):
+    ctx.load()
+    queries = [{'q': {'facet': {'time': data['facets']['time'][:2]},
+                      'limit': 50, 'withvalues': True}}
+               for data in ctx.inputs]
+    return measure(lambda query: ctx.call('POST', '/stats/find-values', query),
+                   queries)
+
+def bench_aggregate_range(ctx):
+    ctx.load()
+    queries = [{'q': {'facet': {'time': data['facets']['time'][:2]},
+                      'start': 1, 'end': 15, 'ops': ['sum', 'avg']}}
+               for data in ctx.inputs]
+    return measure(lambda query: ctx.call('POST', '/stats/aggregate-range', query),
+                   queries)
+
+def bench_end_to_end(ctx):
+    """
+    Records submitted through the sink, drained from the queue by the
+    aggregator and synced into HyperDex.
+    """
+    ctx.reset()
+    def run(_):
+        for data in ctx.inputs:
+            ctx.call('POST', '/stats', data)
+        while True:
+            data = ctx.redis.lpop('aggqueue')
+            if data is None:
+                break
+            ctx.aggregator._handle(data)
+        ctx.aggregator.sync_redis(force=True)
+        return len(ctx.inputs)
+    return measure(run, [None])
+
+
+def connect_redis(spec):
+    """
+    Either 'fake' for an in-process fakeredis, or HOST[:PORT][/DB]
+    """
+    if spec == 'fake':
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("fakeredis is not installed, use --redis HOST:PORT/DB")
+        return fakeredis.FakeStrictRedis()
+    from redis import StrictRedis
+    db = 0
+    if '/' in spec:
+        spec, db = spec.split('/', 1)
+    host, _, port = spec.partition(':')
+    return StrictRedis(host=host or 'localhost', port=int(port or 6379),
+                       db=int(db))
+
+def compare(baseline, current):
+    """
+    Print the throughput change of each benchmark relative to a previous run
+    """
+    for name, result in sorted(current['results'].items()):
+        previous = baseline.get('results', {}).get(name)
+        if previous is None or not previous['ops_per_sec']:
+            continue
+        ratio = result['ops_per_sec'] / previous['ops_per_sec']
+        print >>sys.stderr, '%-20s %12.1f ops/s  %+7.1f%%' % (
+            name, result['ops_per_sec'], (ratio - 1) * 100)
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='python -mhyperstats bench',
+                                     description='Benchmark the HyperStats hot paths')
+    parser.add_argument('-n', '--records', type=int, default=1000,
+                        help='Number of random records to use')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+                        help='Random seed, keep it fixed to compare runs')
+    parser.add_argument('-r', '--redis', default='fake',
+                        help="'fake' or HOST:PORT/DB, the database will be FLUSHED")
+    parser.add_argument('-o', '--output', default='-',
+                        help='Write JSON results to this file')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON results of a previous run to compare against')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run, default all: %s' % (', '.join(BENCHMARKS),))
+    opts = parser.parse_args(args)
+    for name in opts.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '%s'" % (name,))
+
+    ctx = BenchContext(connect_redis(opts.redis), opts.records, opts.seed)
+    results = {}
+    for name in (opts.benchmarks or BENCHMARKS):
+        print >>sys.stderr, 'running', name
+        random.seed(opts.seed)
+        results[name] = globals()['bench_' + name](ctx)
+
+    output = {
+        'timestamp': unixtime(),
+        'python': platform.python_version(),
+        'redis': opts.redis,
+        'records': opts.records,
+        'seed': opts.seed,
+        'results': results,
+    }
+    if opts.baseline:
+        with open(opts.baseline) as handle:
+            compare(json.load(handle), output)
+    if opts.output == '-':
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(opts.output, 'w') as handle:
+            json.dump(output, handle, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -28,6 +28,8 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 __all__ = ['ClientException', 'Client']
 
+from random import uniform
+from time import sleep
 import requests, json
 
 class ClientException(Exception):
@@ -37,18 +39,41 @@ class Client(object):
     """
     The Client allows you to send data to the HyperStats system in the 
     most effecient way possible.
+
+    When the server is overloaded (429 or 503) the request is retried up to
+    `max_retries` times, waiting at least as long as the Retry-After header
+    asks with exponential backoff and random jitter, so clients which were
+    refused together don't all come back at the same time.
     """
-    def __init__(self, api_url):
+    RETRY_STATUS = [429, 503]
+
+    def __init__(self, api_url, max_retries=5, backoff=0.1, max_backoff=30):
         assert isinstance(api_url, basestring)
         self._api_url = api_url.rstrip('/ ')
         self._session = requests.Session()
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+    def _retry_delay(self, attempt, response):
+        """
+        Seconds to wait before retrying a refused request
+        """
+        delay = min(self._max_backoff, self._backoff * pow(2, attempt))
+        try:
+            delay = max(delay, float(response.headers.get('Retry-After', 0)))
+        except ValueError:
+            pass
+        return uniform(delay, delay * 2)
 
-    def send(self, bucket, guid, facets, values):
+    def send(self, bucket, guid, facets, values, distinct=None, samples=None):
         """
         :param bucket: Name of data bucket to insert into
         :param guid: Unique ID for this record
         :param facets: Dictionary of facets
         :param values: Dictionary of values
+        :param distinct: Dictionary of items to count distinctly
+        :param samples: Dictionary of numbers to track the quantiles of
         """
         assert isinstance(bucket, basestring)
         assert isinstance(guid, basestring)
@@ -59,11 +84,24 @@ class Client(object):
             'facets': facets,
             'values': values
         }
+        if distinct:
+            assert type(distinct) == dict
+            payload['distinct'] = distinct
+        if samples:
+            assert type(samples) == dict
+            payload['samples'] = samples
         headers = {'Content-type': 'application/json',
                    'Accept': 'application/json'}
         url = '%s/%s' % (self._api_url, bucket)
-        response = self._session.post(url, data=json.dumps(payload),
-                                           headers=headers)
+        body = json.dumps(payload)
+        attempt = 0
+        while True:
+            response = self._session.post(url, data=body, headers=headers)
+            if response.status_code not in self.RETRY_STATUS \
+               or attempt >= self._max_retries:
+                break
+            sleep(self._retry_delay(attempt, response))
+            attempt += 1
 
         data = response.json()
         if data.get('ok', False):
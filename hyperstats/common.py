@@ -27,7 +27,9 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 __all__ = ['make_facet_id', 'flatten_facet', 'all_permutations', 'Daemon',
-           'QueueDaemon', 'unixtime', 'to_utf8_str', 'split_facet']
+           'QueueDaemon', 'unixtime', 'to_utf8_str', 'split_facet',
+           'facet_levels', 'ValidationError', 'shard_facet', 'shard_parent_id',
+           'SHARDS_VALUE']
 
 from base64 import b64encode
 from time import time as unixtime
@@ -74,7 +76,7 @@ class DataObject(object):
     def asdict(self):
         return dict(
             (att, getattr(self, att)) for att in self.__slots__)
-n
+
     def astuple(self):
         return tuple(getattr(self, att) for att in self.__slots__)
 
@@ -84,6 +86,12 @@ n
             ', '.join('{}={}'.format(
                     att, repr(getattr(self, att))) for att in self.__slots__))
 
+class ValidationError(Exception):
+    """
+    Data the user provided isn't sane.
+    """
+    pass
+
 def to_utf8_str(obj):
     """
     Converts argument into a utf-8 byte string
@@ -99,6 +107,18 @@ def to_utf8_str(obj):
         return "%f" % (obj)
     raise TypeError, "Cannot convert type '%s' to utf-8 string" % (type(obj),)
 
+def facet_levels(facets):
+    """
+    Converts sanitized facets into the list of lists used for facet IDs
+
+        [('derp', [123, 456]), ('merp', [987])]
+
+    becomes
+
+        [['derp', 123, 456], ['merp', 987]]
+    """
+    return [[name] + list(values) for name, values in facets]
+
 def split_facet(facet):
     """
     Returns a dictionary of the following elements:
@@ -122,6 +142,28 @@ def split_facet(facet):
         'child': facet_child
     }
 
+# Reserved value marking a facet whose counters are split across shards
+SHARDS_VALUE = '$hs.shards'
+
+def shard_parent_id(facet_id):
+    """
+    The shards of a hot facet are stored as the children of this ID, which
+    no real facet has, so they don't show up as children of its parent.
+    """
+    return facet_id + '#'
+
+def shard_facet(facet, shard):
+    """
+    Split facet dictionary for one shard of a hot facet, which remembers the
+    facet it's a shard of.
+    """
+    return {
+        'id': '%s#%d' % (facet['id'], shard),
+        'parent_id': shard_parent_id(facet['id']),
+        'child': '%d' % (shard,),
+        'shard_of': facet
+    }
+
 def make_facet_id(facet):
     """
     Unique ID for the facet
@@ -192,17 +234,20 @@ def all_permutations(inputs):
     Values can be floats, ints and strings.
     Or they can be lists of ints, floats and strings.
     """
-    sets = {}
+    # Keys keep the order they were given in, so the facet IDs match those
+    # produced from the same sorted facets when querying
+    sets = []
     if type(inputs) == dict:
-        inputs = inputs.items()
+        inputs = sorted(inputs.items())
     for key, levels in inputs:
         combos = []
+        key_set = []
         for level in levels:
             combos.append(level)
-            if key not in sets:
-                sets[key] = []
-            sets[key].append([key] + combos)
-    all_points = power_set(sets.values())
+            key_set.append([key] + combos)
+        if key_set:
+            sets.append(key_set)
+    all_points = power_set(sets)
     ret = []
     for lol in all_points:
         ret += permute(lol)
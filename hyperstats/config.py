@@ -0,0 +1,92 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['Config', 'load_config']
+
+from hyperstats.common import DataObject
+from ConfigParser import SafeConfigParser
+import os
+
+# Settings which can be given in the [hyperstats] section or the environment
+SETTINGS = (
+    'redis_host',
+    'redis_port',
+    'redis_db',
+    'redis_pool_size',
+    'hyperdex_host',
+    'hyperdex_port',
+    'hyperdex_pool_size',
+    'pool_timeout',
+)
+
+class Config(DataObject):
+    """
+    Where to find Redis and HyperDex, and how many connections to pool.
+
+    `buckets` has the options of each [bucket:NAME] section of the config
+    file by bucket name, which schemas and cardinality limits are made from.
+    """
+    __slots__ = SETTINGS + ('buckets',)
+
+DEFAULTS = Config(redis_host='localhost',
+                  redis_port=6379,
+                  redis_db=0,
+                  redis_pool_size=50,
+                  hyperdex_host='10.0.3.23',
+                  hyperdex_port=10502,
+                  hyperdex_pool_size=8,
+                  pool_timeout=10.0)
+
+def load_config(path=None):
+    """
+    Start with the defaults, then read the [hyperstats] section of the config
+    file at `path` (or $HYPERSTATS_CONFIG), then override with environment
+    variables named after the settings, e.g. $HYPERSTATS_REDIS_HOST.
+    """
+    config = Config(*DEFAULTS.astuple())
+    config.buckets = {}
+    path = path or os.environ.get('HYPERSTATS_CONFIG')
+    settings = {}
+    if path:
+        parser = SafeConfigParser()
+        if not parser.read(path):
+            raise IOError("Cannot read config file '%s'" % (path,))
+        if parser.has_section('hyperstats'):
+            settings.update(parser.items('hyperstats'))
+        for section in parser.sections():
+            if section.startswith('bucket:'):
+                config.buckets[section[len('bucket:'):]] = dict(parser.items(section))
+    for name in SETTINGS:
+        env_name = 'HYPERSTATS_' + name.upper()
+        if env_name in os.environ:
+            settings[name] = os.environ[env_name]
+    for name, value in settings.items():
+        if name not in SETTINGS:
+            raise ValueError("Unknown config setting '%s'" % (name,))
+        setattr(config, name, type(getattr(DEFAULTS, name))(value))
+    return config
@@ -1,10 +1,154 @@
-from redis import StrictRedis
-import hyperclient
+from redis import StrictRedis, BlockingConnectionPool
+from hyperstats.common import DataObject, unixtime
+from hyperstats.config import load_config
+from contextlib import contextmanager
+import hyperclient, gevent.queue
 
-__all__ = ['redis_connect', 'hyperdex_connect']
+__all__ = ['redis_connect', 'hyperdex_connect', 'PoolStats', 'HyperDexPool',
+           'Connections']
 
-def redis_connect():
-    return StrictRedis()
+class PoolStats(DataObject):
+    """
+    How long callers waited to take a connection from a pool, when the waits
+    grow the pool is too small.
+    """
+    default_value = 0
+    __slots__ = (
+        'checkouts',
+        'created',
+        'waited',
+        'wait_time',
+        'max_wait',
+    )
 
-def hyperdex_connect():
-    return hyperclient.Client('10.0.3.23', 10501)
\ No newline at end of file
+    def record(self, seconds):
+        self.checkouts += 1
+        if seconds > 0.001:
+            self.waited += 1
+        self.wait_time += seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+
+class TimedConnectionPool(BlockingConnectionPool):
+    """
+    Redis connection pool which blocks when all connections are in use,
+    recording how long callers waited.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TimedConnectionPool, self).__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def make_connection(self):
+        self.stats.created += 1
+        return super(TimedConnectionPool, self).make_connection()
+
+    def get_connection(self, *args, **kwargs):
+        begin = unixtime()
+        try:
+            return super(TimedConnectionPool, self).get_connection(*args, **kwargs)
+        finally:
+            self.stats.record(unixtime() - begin)
+
+
+class HyperDexPool(object):
+    """
+    Pool of HyperDex clients, each is only used by one greenlet at a time.
+    Clients are created as needed, up to `size`.
+    """
+    def __init__(self, hostname, port, size, timeout=None):
+        self._hostname = hostname
+        self._port = port
+        self._size = size
+        self._timeout = timeout
+        self._clients = gevent.queue.LifoQueue()
+        self.stats = PoolStats()
+
+    @contextmanager
+    def client(self):
+        begin = unixtime()
+        try:
+            client = self._clients.get_nowait()
+        except gevent.queue.Empty:
+            if self.stats.created < self._size:
+                # Only counted once it exists, so a failed connection
+                # doesn't use up the pool's capacity
+                client = hyperclient.Client(self._hostname, self._port)
+                self.stats.created += 1
+            else:
+                client = self._clients.get(timeout=self._timeout)
+        self.stats.record(unixtime() - begin)
+        try:
+            yield client
+        finally:
+            self._clients.put(client)
+
+    def get(self, space, key):
+        with self.client() as client:
+            return client.get(space, key)
+
+    def search(self, space, predicate):
+        with self.client() as client:
+            return list(client.search(space, predicate))
+
+    def sorted_search(self, space, predicate, sortby, limit, maxmin):
+        with self.client() as client:
+            return list(client.sorted_search(space, predicate, sortby, limit, maxmin))
+
+
+def redis_connect(config=None):
+    config = config or load_config()
+    pool = TimedConnectionPool(host=config.redis_host, port=config.redis_port,
+                               db=config.redis_db,
+                               max_connections=config.redis_pool_size,
+                               timeout=config.pool_timeout)
+    return StrictRedis(connection_pool=pool)
+
+def hyperdex_connect(config=None):
+    config = config or load_config()
+    return HyperDexPool(config.hyperdex_host, config.hyperdex_port,
+                        config.hyperdex_pool_size, config.pool_timeout)
+
+
+class Connections(object):
+    """
+    Redis and HyperDex connections, created when they're first used.
+    """
+    def __init__(self, config=None, redis=None, hyperdex=None):
+        self.config = config
+        self._redis = redis
+        self._hyperdex = hyperdex
+
+    def _config(self):
+        if self.config is None:
+            self.config = load_config()
+        return self.config
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis_connect(self._config())
+        return self._redis
+
+    @property
+    def hyperdex(self):
+        if self._hyperdex is None:
+            self._hyperdex = hyperdex_connect(self._config())
+        return self._hyperdex
+
+    def stats(self):
+        """
+        Connection pool statistics, for those pools which exist
+        """
+        stats = {}
+        for name, conn in [('redis', self._redis), ('hyperdex', self._hyperdex)]:
+            pool = getattr(conn, 'connection_pool', conn)
+            if hasattr(pool, 'stats'):
+                stats[name] = pool.stats.asdict()
+        return stats
+
+    def reset(self):
+        """
+        Forget the connections, e.g. in a forked child process
+        """
+        self._redis = None
+        self._hyperdex = None
@@ -0,0 +1,392 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['Exporter', 'NpzWriter', 'ParquetWriter', 'main']
+
+from hyperstats.config import load_config
+from hyperstats.common import make_facet_id, flatten_facet, facet_levels, shard_parent_id, SHARDS_VALUE
+from hyperstats.schema import load_schemas
+from itertools import chain
+from multiprocessing import Pool
+import hyperclient, argparse, logging, json, glob, os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOG = logging.getLogger(__name__)
+
+# Facet IDs are base64 encoded, these are the characters they start with in
+# sort order, records are split between partitions by the first character
+ID_ALPHABET = ''.join(sorted('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'))
+
+def partition_of(facet_id, partitions):
+    return ID_ALPHABET.index(facet_id[0]) * partitions // len(ID_ALPHABET)
+
+
+class NpzWriter(object):
+    """
+    Writes columns to a compressed NumPy .npz file
+    """
+    extension = 'npz'
+
+    def __init__(self):
+        if numpy is None:
+            raise RuntimeError("Exporting to .npz requires numpy")
+
+    def write(self, path, columns):
+        with open(path, 'wb') as handle:
+            numpy.savez_compressed(handle, **dict(
+                (name, numpy.array(column)) for name, column in columns))
+
+    def read_ids(self, path):
+        with numpy.load(path) as data:
+            return data['id'].tolist()
+
+
+class ParquetWriter(object):
+    """
+    Writes columns to a Parquet file
+    """
+    extension = 'parquet'
+
+    def __init__(self):
+        if pyarrow is None:
+            raise RuntimeError("Exporting to Parquet requires pyarrow")
+
+    def write(self, path, columns):
+        table = pyarrow.Table.from_arrays([pyarrow.array(column) for _, column in columns],
+                                          [name for name, _ in columns])
+        pyarrow.parquet.write_table(table, path)
+
+    def read_ids(self, path):
+        return pyarrow.parquet.read_table(path, columns=['id']).column('id').to_pylist()
+
+WRITERS = {'npz': NpzWriter, 'parquet': ParquetWriter}
+
+
+def make_columns(rows):
+    """
+    Columns of the facet ID, parent ID, child and one 'values.NAME' column
+    for every value. Facets without a value have 0 for it, which is what an
+    absent counter adds up to.
+    """
+    names = sorted(set(name for row in rows for name in row['values']))
+    columns = [('id', [row['id'] for row in rows]),
+               ('parent_id', [row['facet_parent_id'] for row in rows]),
+               ('facet', [row['facet'] for row in rows])]
+    for name in names:
+        columns.append(('values.' + name, [row['values'].get(name, 0) for row in rows]))
+    return columns
+
+
+class Exporter(object):
+    """
+    Streams records out of the stats space into columnar part files, at most
+    `rows` records per file so memory use doesn't depend on the size of the
+    space.
+
+    Records are shared between partitions by the first character of their
+    ID, so separate processes can export one partition each. HyperDex can't
+    narrow a search on the hashed key, so exporting everything is one scan
+    of the whole space per partition keeping its share of the records, N
+    partitions read the space N times.
+    When exporting the subtree under a parent facet, each child of the
+    parent with its descendants is a unit of work, and the partition of its
+    ID exports it.
+
+    The subtree of a parent has the deeper levels of its last dimension,
+    and the facets which add a level of a later dimension (in name order)
+    to it or any of those, e.g. beneath `device/tablet` is
+    `device/tablet/time/2012`. Facet IDs are hashed, so the names of the
+    bucket's dimensions must be given to find them.
+
+    A unit's part files are named after it, and it's recorded in the
+    partition's progress file once all of them are written. Exporting again
+    into the same directory skips the units which were finished, and keeps
+    the parts written of an unfinished one, skipping the records in them.
+    The order of a search isn't guaranteed, so the IDs of those records
+    are read back and kept in memory while the unit is exported.
+
+    Only the values are exported, not the distinct count or quantile
+    sketches. The space isn't snapshotted, records updated while exporting
+    may or may not include the updates.
+    """
+    def __init__(self, hdex, space, directory, writer, rows=100000, parent=None,
+                 dimensions=()):
+        """
+        :param hdex: HyperDex client, `search` must return an iterator
+        :param parent: Sanitized facets to export the subtree of, e.g.
+                       [('device', ['tablet'])], default everything
+        :param dimensions: Names of the bucket's dimensions
+        """
+        self._hdex = hdex
+        self._space = space
+        self._directory = directory
+        self._writer = writer
+        self._rows = rows
+        self._parent = parent
+        self._dimensions = sorted(dimensions)
+
+    def _children(self, facet, dimension):
+        """
+        The records one level beneath the flattened `facet`, whose last
+        dimension is `dimension`, as tuples of (record, flattened facet,
+        last dimension)
+        """
+        parents = [(facet, dimension)]
+        parents += [(facet + [name], name) for name in self._dimensions if name > dimension]
+        for parent, name in parents:
+            for record in self._hdex.search(self._space, {'facet_parent_id': make_facet_id(parent)}):
+                yield record, parent + [record['facet']], name
+
+    def _shards(self, record):
+        """
+        Shards of the record if it's a hot facet, they have nothing beneath them
+        """
+        if SHARDS_VALUE not in record['values']:
+            return []
+        return self._hdex.search(self._space, {'facet_parent_id': shard_parent_id(record['id'])})
+
+    def _descendants(self, facet, dimension):
+        """
+        Everything beneath the flattened facet, depth first
+        """
+        parents = [(facet, dimension)]
+        while parents:
+            facet, dimension = parents.pop()
+            for record, child, name in self._children(facet, dimension):
+                yield record
+                for shard in self._shards(record):
+                    yield shard
+                parents.append((child, name))
+
+    def _root_records(self, facet):
+        """
+        The flattened facet, and its shards if it's hot
+        """
+        facet_id = make_facet_id(facet)
+        record = self._hdex.get(self._space, facet_id)
+        if record is None:
+            return
+        record['id'] = facet_id
+        yield record
+        for shard in self._shards(record):
+            yield shard
+
+    def _scan(self, partition, partitions):
+        for record in self._hdex.search(self._space, {}):
+            if partition_of(record['id'], partitions) == partition:
+                yield record
+
+    def units(self, partition, partitions):
+        """
+        List of (name, records) of the units of work of one partition, the
+        records are only searched for when iterated over
+        """
+        if self._parent is None:
+            return [('all-%d' % (partition,), self._scan(partition, partitions))]
+        parent = flatten_facet(facet_levels(self._parent))
+        # The parent itself goes along with the first partition
+        units = []
+        if partition == 0:
+            units.append(('root', self._root_records(parent)))
+        children = self._children(parent, self._parent[-1][0])
+        for record, facet, dimension in sorted(children, key=lambda child: child[0]['id']):
+            if partition_of(record['id'], partitions) != partition:
+                continue
+            name = record['id'].replace('/', '_').replace('+', '-')
+            units.append((name, chain(self._root_records(facet),
+                                      self._descendants(facet, dimension))))
+        return units
+
+    def _progress_path(self, partition):
+        return os.path.join(self._directory, 'progress-%d' % (partition,))
+
+    def finished(self):
+        """
+        Names of the units finished by any partition
+        """
+        done = set()
+        for path in glob.glob(os.path.join(self._directory, 'progress-*')):
+            with open(path) as handle:
+                done.update(line.strip() for line in handle if line.strip())
+        return done
+
+    def _part_path(self, name, number):
+        return os.path.join(self._directory, 'part-%s-%05d.%s' % (
+                            name, number, self._writer.extension))
+
+    def _write_part(self, name, number, rows):
+        path = self._part_path(name, number)
+        self._writer.write(path + '.tmp', make_columns(rows))
+        os.rename(path + '.tmp', path)
+
+    def _written_parts(self, name):
+        """
+        Number of the parts of the unit written by an interrupted attempt,
+        and the IDs of the records in them
+        """
+        written = set()
+        number = 0
+        while os.path.exists(self._part_path(name, number)):
+            written.update(self._writer.read_ids(self._part_path(name, number)))
+            number += 1
+        return number, written
+
+    def export_unit(self, name, records):
+        """
+        Write the records of the unit which aren't in its parts already,
+        returns how many were written
+        """
+        number, written = self._written_parts(name)
+        if number:
+            LOG.info("Resuming '%s' after %d parts with %d records",
+                     name, number, len(written))
+        total = 0
+        rows = []
+        for record in records:
+            if record['id'] in written:
+                continue
+            rows.append(record)
+            if len(rows) >= self._rows:
+                self._write_part(name, number, rows)
+                total += len(rows)
+                number += 1
+                rows = []
+        if rows or not number:
+            self._write_part(name, number, rows)
+            total += len(rows)
+        return total
+
+    def export_partition(self, partition, partitions):
+        """
+        Export the unfinished units of one partition
+        """
+        done = self.finished()
+        total = 0
+        with open(self._progress_path(partition), 'a') as progress:
+            for name, records in self.units(partition, partitions):
+                if name in done:
+                    continue
+                total += self.export_unit(name, records)
+                progress.write(name + '\n')
+                progress.flush()
+                os.fsync(progress.fileno())
+        LOG.info("Partition %d exported %d records", partition, total)
+        return total
+
+
+def check_manifest(directory, manifest):
+    """
+    Make sure a resumed export has the same settings as when it started
+    """
+    path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(path):
+        with open(path) as handle:
+            existing = json.load(handle)
+        if existing != manifest:
+            raise ValueError("'%s' contains a different export: %r" % (directory, existing))
+    else:
+        with open(path, 'w') as handle:
+            json.dump(manifest, handle)
+
+def export_partition(job):
+    """
+    Export one partition in a worker process, with its own HyperDex client
+    """
+    opts, parent, dimensions, partition = job
+    config = load_config(opts.config)
+    hdex = hyperclient.Client(config.hyperdex_host, config.hyperdex_port)
+    exporter = Exporter(hdex, opts.space, opts.directory, WRITERS[opts.format](),
+                        opts.rows, parent, dimensions)
+    return exporter.export_partition(partition, opts.partitions)
+
+def main(args):
+    from hyperstats.httpd import sanitized_facets
+    parser = argparse.ArgumentParser(prog='python -mhyperstats export')
+    parser.add_argument('--config',
+                        help='Config file with HyperDex settings, default $HYPERSTATS_CONFIG')
+    parser.add_argument('--space', default='stats')
+    parser.add_argument('--parent',
+                        help='Only export beneath this facet, as JSON e.g. \'{"time": [2012]}\'')
+    parser.add_argument('--dimensions',
+                        help='Dimensions of the bucket, needed with --parent,'
+                             ' default those of its schema')
+    parser.add_argument('-f', '--format', choices=sorted(WRITERS.keys()), default='npz')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Records per part file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Partitions exported in parallel')
+    parser.add_argument('--partitions', type=int,
+                        help='Number of partitions, default the number of jobs.'
+                             ' Without --parent each one scans the whole space')
+    parser.add_argument('--partition', type=int,
+                        help='Only export this partition, e.g. one per machine')
+    parser.add_argument('directory', help='Directory to write to, or resume in')
+    opts = parser.parse_args(args)
+    opts.partitions = opts.partitions or opts.jobs
+
+    parent = parent_id = None
+    dimensions = []
+    if opts.parent:
+        parent = sanitized_facets(json.loads(opts.parent))
+        parent_id = make_facet_id(flatten_facet(facet_levels(parent)))
+        if opts.dimensions:
+            dimensions = opts.dimensions.replace(',', ' ').split()
+        else:
+            schema = load_schemas(load_config(opts.config)).get(opts.space)
+            if schema is None:
+                parser.error("--parent needs --dimensions, or a schema for '%s'" % (opts.space,))
+            dimensions = schema.dimensions.keys()
+        dimensions = sorted(set(dimensions) | set(name for name, _ in parent))
+    if not os.path.isdir(opts.directory):
+        os.makedirs(opts.directory)
+    check_manifest(opts.directory, {'space': opts.space, 'parent_id': parent_id,
+                                    'dimensions': dimensions, 'format': opts.format,
+                                    'partitions': opts.partitions})
+
+    if opts.partition is not None:
+        partitions = [opts.partition]
+    else:
+        partitions = range(opts.partitions)
+    jobs = [(opts, parent, dimensions, partition) for partition in partitions]
+    if opts.jobs > 1:
+        pool = Pool(opts.jobs)
+        totals = pool.map(export_partition, jobs)
+        pool.close()
+    else:
+        totals = map(export_partition, jobs)
+    print "Exported %d records to %s" % (sum(totals), opts.directory)
@@ -27,34 +27,307 @@ ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-__all__ = []
+__all__ = ['random_id', 'random_record', 'ZipfGenerator', 'RecordGenerator',
+           'LatencyHistogram', 'main']
 
-from random import randint, choice
+from random import randint, choice, random
 from os import urandom
 from base64 import b32encode
+from bisect import bisect_left
+from math import log
 from hyperstats.client import Client
+from hyperstats.common import unixtime
+import argparse, json, sys
 
 def random_id():
     return b32encode(urandom(5))
 
 MAGAZINES = ['Mayfair', 'Playboy', 'Hustler']
 
-def main():
-    client = Client('http://localhost:8080/')
-    bucket = 'stats'
-
-    while True:
-        year = randint(2006, 2012)
-        month = randint(1, 12)
-        day = randint(1, 28)
-        hour = randint(1, 24)        
-        facets = dict(time=[year, month, day, hour],
-                      device=[choice(['tablet', 'phone']), choice(['apple', 'samsung'])],
-                      content=[randint(10, 15), choice(MAGAZINES), 'Issue %d' % randint(1, 20)])
+def random_record():
+    """
+    Returns a tuple of (facets, values) for a single random record
+    """
+    year = randint(2006, 2012)
+    month = randint(1, 12)
+    day = randint(1, 28)
+    hour = randint(1, 24)
+    facets = dict(time=[year, month, day, hour],
+                  device=[choice(['tablet', 'phone']), choice(['apple', 'samsung'])],
+                  content=[randint(10, 15), choice(MAGAZINES), 'Issue %d' % randint(1, 20)])
+    values = dict(datapoints=1,
+                  view_duration=randint(1, 500),
+                  revenue=randint(1, 10))
+    return facets, values
+
+
+class ZipfGenerator(object):
+    """
+    Picks integers in the range [0, count) following a Zipf distribution with
+    exponent `skew`. A skew of 0 is uniform, around 1 is typical of real
+    traffic where a few values are very hot.
+    """
+    def __init__(self, count, skew):
+        assert count > 0
+        total = 0.0
+        self._cumulative = []
+        for rank in range(1, count + 1):
+            total += 1.0 / pow(rank, skew)
+            self._cumulative.append(total)
+        self._total = total
+
+    def next(self):
+        return bisect_left(self._cumulative, random() * self._total)
+
+
+class RecordGenerator(object):
+    """
+    Generates records with `dimensions` facets, each `depth` levels deep with
+    `cardinality` possible values at every level, chosen with a Zipf skew.
+    """
+    def __init__(self, dimensions, depth, cardinality, skew):
+        self._names = ['dim%d' % (i,) for i in range(dimensions)]
+        self._depth = depth
+        self._zipf = ZipfGenerator(cardinality, skew)
+
+    def __call__(self):
+        facets = {}
+        for name in self._names:
+            facets[name] = ['v%d' % (self._zipf.next(),)
+                            for _ in range(self._depth)]
         values = dict(datapoints=1,
                       view_duration=randint(1, 500),
                       revenue=randint(1, 10))
+        return facets, values
+
+
+class LatencyHistogram(object):
+    """
+    Fixed memory latency histogram, buckets are 1% wide so percentiles are
+    accurate to within 1% no matter how many samples are recorded.
+    """
+    PRECISION = log(1.01)
+
+    def __init__(self):
+        self._buckets = {}
+        self.count = 0
+
+    def add(self, seconds):
+        index = int(log(max(seconds, 1e-6) * 1e6) / self.PRECISION)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += other.count
+
+    def percentile(self, fraction):
+        """
+        Latency in seconds which `fraction` of the samples were below
+        """
+        if self.count == 0:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index in sorted(self._buckets.keys()):
+            seen += self._buckets[index]
+            if seen >= wanted:
+                break
+        return pow(1.01, index + 1) / 1e6
+
+
+class LoadStats(object):
+    """
+    Counts sent records and errors, with latency for the current reporting
+    interval and since the start.
+    """
+    def __init__(self):
+        self.start = unixtime()
+        self.sent = 0
+        self.errors = 0
+        self.total = LatencyHistogram()
+        self.interval = LatencyHistogram()
+        self._interval_start = self.start
+        self._interval_sent = 0
+
+    def record(self, latency, ok):
+        if ok:
+            self.sent += 1
+            self.interval.add(latency)
+        else:
+            self.errors += 1
+
+    def summary(self, histogram, sent, seconds):
+        return {
+            'sent': sent,
+            'errors': self.errors,
+            'seconds': seconds,
+            'rate': (sent / seconds) if seconds > 0 else 0.0,
+            'p50_ms': histogram.percentile(0.50) * 1000,
+            'p99_ms': histogram.percentile(0.99) * 1000,
+            'p999_ms': histogram.percentile(0.999) * 1000,
+        }
+
+    def report(self):
+        """
+        Summary of the interval since the last report, then starts a new one
+        """
+        now = unixtime()
+        result = self.summary(self.interval, self.sent - self._interval_sent,
+                              now - self._interval_start)
+        self.total.merge(self.interval)
+        self.interval = LatencyHistogram()
+        self._interval_start = now
+        self._interval_sent = self.sent
+        return result
+
+    def final(self):
+        self.report()
+        return self.summary(self.total, self.sent, unixtime() - self.start)
+
+
+def send_record(client, bucket, generate, stats, scheduled=None):
+    """
+    Send one record, the latency is measured from when it was scheduled to be
+    sent to avoid hiding queueing delays in open-loop mode.
+    """
+    begin = unixtime() if scheduled is None else scheduled
+    facets, values = generate()
+    try:
         client.send(bucket, random_id(), facets, values)
+        ok = True
+    except Exception:
+        ok = False
+    stats.record(unixtime() - begin, ok)
+
+def run_load(opts, generate, stats):
+    """
+    Closed-loop: each sender waits for its response before sending again,
+    optionally paced so all senders together don't exceed --rate.
+
+    Open-loop: records are sent on a fixed schedule at --rate regardless of
+    how long responses take, with at most --concurrency in flight.
+    """
+    import gevent, gevent.pool, gevent.queue
+
+    deadline = (stats.start + opts.duration) if opts.duration else None
+    clients = gevent.queue.Queue()
+    for _ in range(opts.concurrency):
+        clients.put(Client(opts.url))
+    schedule = {'next': unixtime(), 'count': 0}
+    interval = (1.0 / opts.rate) if opts.rate else 0.0
+
+    def next_slot():
+        """
+        Returns the time of the next send, or None when done
+        """
+        if opts.count and schedule['count'] >= opts.count:
+            return None
+        slot = schedule['next']
+        if deadline is not None and slot >= deadline:
+            return None
+        schedule['count'] += 1
+        if not interval:
+            schedule['next'] = unixtime()
+        elif opts.open_loop:
+            schedule['next'] = slot + interval
+        else:
+            # Closed-loop senders which fell behind may only catch up by 1s
+            schedule['next'] = max(slot, unixtime() - 1) + interval
+        return slot
+
+    def send(scheduled):
+        client = clients.get()
+        try:
+            send_record(client, opts.bucket, generate, stats, scheduled)
+        finally:
+            clients.put(client)
+
+    def reporter():
+        while True:
+            gevent.sleep(opts.interval)
+            print_stats(stats.report())
+
+    report_greenlet = gevent.spawn(reporter)
+    try:
+        if opts.open_loop:
+            pool = gevent.pool.Pool(opts.concurrency)
+            while True:
+                slot = next_slot()
+                if slot is None:
+                    break
+                gevent.sleep(max(0, slot - unixtime()))
+                pool.spawn(send, slot)
+            pool.join()
+        else:
+            def sender():
+                while True:
+                    slot = next_slot()
+                    if slot is None:
+                        return
+                    gevent.sleep(max(0, slot - unixtime()))
+                    send(None)
+            gevent.joinall([gevent.spawn(sender)
+                            for _ in range(opts.concurrency)])
+    finally:
+        report_greenlet.kill()
+
+def print_stats(result):
+    print >>sys.stderr, ('rate:%.1f/s sent:%d errors:%d p50:%.2fms p99:%.2fms p999:%.2fms'
+                         % (result['rate'], result['sent'], result['errors'],
+                            result['p50_ms'], result['p99_ms'], result['p999_ms']))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -mhyperstats fakegen',
+                                     description='Generate load against the httpd sink')
+    parser.add_argument('-u', '--url', default='http://localhost:8080/')
+    parser.add_argument('-b', '--bucket', default='stats')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='Target records per second, default unlimited')
+    parser.add_argument('--open-loop', action='store_true',
+                        help='Send on a fixed schedule at --rate, ignoring response times')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='Concurrent senders, or in-flight limit when open-loop')
+    parser.add_argument('-n', '--count', type=int, default=0,
+                        help='Stop after this many records')
+    parser.add_argument('-t', '--duration', type=float, default=0,
+                        help='Stop after this many seconds')
+    parser.add_argument('-i', '--interval', type=float, default=5,
+                        help='Seconds between progress reports')
+    parser.add_argument('-d', '--dimensions', type=int, default=0,
+                        help='Number of facet dimensions, default the built-in magazine records')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Levels in each dimension')
+    parser.add_argument('--cardinality', type=int, default=10,
+                        help='Distinct values at each level')
+    parser.add_argument('--skew', type=float, default=0,
+                        help='Zipf exponent of value popularity, 0 is uniform')
+    parser.add_argument('-o', '--output',
+                        help='Write the final summary as JSON to this file')
+    opts = parser.parse_args(sys.argv[1:] if args is None else args)
+    if opts.open_loop and not opts.rate:
+        parser.error('--open-loop requires --rate')
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    if opts.dimensions:
+        generate = RecordGenerator(opts.dimensions, opts.depth,
+                                   opts.cardinality, opts.skew)
+    else:
+        generate = random_record
+    stats = LoadStats()
+    try:
+        run_load(opts, generate, stats)
+    except KeyboardInterrupt:
+        pass
+
+    result = stats.final()
+    print_stats(result)
+    if opts.output:
+        with open(opts.output, 'w') as handle:
+            json.dump(result, handle, indent=2, sort_keys=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,214 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['CardinalityGuard', 'load_limits', 'guard_status', 'OTHER']
+
+from hyperstats.common import make_facet_id, unixtime
+import logging, re
+
+LOG = logging.getLogger(__name__)
+
+# Facet value which overflowing values are replaced with
+OTHER = '__other__'
+OVERFLOW_ACTIONS = ['other', 'drop']
+# Hash of overflow counts by 'bucket:dimension'
+STATUS_KEY = '$hs.guard'
+# Seconds a limit's admitted values are kept for, unless configured
+DEFAULT_WINDOW = 86400
+
+# Admit the member if it's already in the set, or the set isn't full yet.
+# A new set expires after ARGV[3] seconds, if given.
+ADMIT_SCRIPT = """
+if redis.call('sismember', KEYS[1], ARGV[1]) == 1 then
+    return 1
+end
+local count = redis.call('scard', KEYS[1])
+if count < tonumber(ARGV[2]) then
+    redis.call('sadd', KEYS[1], ARGV[1])
+    if count == 0 and tonumber(ARGV[3]) > 0 then
+        redis.call('expire', KEYS[1], ARGV[3])
+    end
+    return 1
+end
+return 0
+"""
+
+def admitted_key(bucket, dimension, depth, window=0, now=None):
+    """
+    The set of values admitted at one level of a dimension, a new one every
+    `window` seconds
+    """
+    period = int((now or unixtime()) // window) if window else 0
+    return '$hs.card.%s:%s:%d:%d' % (bucket, dimension, depth, period)
+
+def overflow_key(field):
+    return STATUS_KEY + '.' + field
+
+
+class CardinalityGuard(object):
+    """
+    Limits how many distinct values each level of a dimension may have in a
+    bucket, so one client sending e.g. user IDs as a facet can't multiply
+    the number of facets being aggregated.
+
+    Every level of a limited dimension admits up to `limit` distinct values
+    (counting each value under each parent separately) per window of time,
+    the admitted values are kept in a Redis set shared by all aggregators and
+    cached locally. Values which don't fit are replaced with `__other__`,
+    dropping the levels beneath them, or the whole record is dropped.
+
+    Each window starts with an empty set, the set of the previous window
+    expires. A window of 0 keeps the admitted values forever. Deleting a
+    `$hs.card.*` set resets the limit early, aggregators notice within
+    `recheck_interval` seconds once they have found it full.
+
+    Overflows are counted in the `$hs.guard` hash, and the number of distinct
+    values which overflowed is estimated with a HyperLogLog per dimension.
+    """
+    recheck_interval = 60
+
+    def __init__(self, rdb, limits):
+        """
+        :param limits: Dictionary of (bucket, dimension) to tuples of
+                       (limit, action, window), the action being 'other' or
+                       'drop' and the window in seconds
+        """
+        self.redis = rdb
+        self.limits = limits
+        self._admit = rdb.register_script(ADMIT_SCRIPT)
+        # Key of the current set and its cached members, by level
+        self._admitted = {}
+        # When the current set was found to be full, by level
+        self._full = {}
+
+    def _is_admitted(self, level, key, member, limit, window):
+        cached = self._admitted.get(level)
+        if cached is None or cached[0] != key:
+            # A new window, forget the previous one
+            cached = self._admitted[level] = (key, set())
+            self._full.pop(level, None)
+        admitted = cached[1]
+        if member in admitted:
+            return True
+        # Once full only the cached members are admitted, until the set is
+        # checked again in case it was reset
+        full_since = self._full.get(level)
+        if full_since is not None and unixtime() - full_since < self.recheck_interval:
+            return False
+        # The set outlives its window, so it can't expire while in use
+        if self._admit(keys=[key], args=[member, limit, window * 2]):
+            if full_since is not None:
+                # It shrank, the cached members may not be in it any more
+                del self._full[level]
+                admitted.clear()
+            admitted.add(member)
+            return True
+        if full_since is None:
+            LOG.warning("Cardinality limit of %d reached for '%s'", limit, key)
+        self._full[level] = unixtime()
+        admitted.update(self.redis.smembers(key))
+        return False
+
+    def _overflowed(self, bucket, dimension, member):
+        field = '%s:%s' % (bucket, dimension)
+        with self.redis.pipeline(False) as pipe:
+            pipe.hincrby(STATUS_KEY, field, 1)
+            pipe.pfadd(overflow_key(field), member)
+            pipe.execute()
+
+    def check(self, record):
+        """
+        Apply the limits of the record's bucket to its facets.
+
+        :returns: The record, or None if it must be dropped
+        """
+        bucket = record.get('bucket')
+        facets = []
+        for dimension, levels in record['facets']:
+            limit = self.limits.get((bucket, dimension))
+            if limit is not None:
+                count, action, window = limit
+                now = unixtime()
+                for depth in range(len(levels)):
+                    member = make_facet_id([dimension] + levels[:depth + 1])
+                    key = admitted_key(bucket, dimension, depth, window, now)
+                    if not self._is_admitted((bucket, dimension, depth), key,
+                                             member, count, window):
+                        self._overflowed(bucket, dimension, member)
+                        if action == 'drop':
+                            return None
+                        levels = levels[:depth] + [OTHER]
+                        break
+            facets.append((dimension, levels))
+        record['facets'] = facets
+        return record
+
+
+def guard_status(rdb):
+    """
+    Overflow counts, and estimated number of distinct overflowing values, of
+    every dimension which has gone over its limit.
+    """
+    status = {}
+    for field, count in rdb.hgetall(STATUS_KEY).items():
+        status[field] = {'overflowed': int(count),
+                         'distinct': rdb.pfcount(overflow_key(field))}
+    return status
+
+
+def load_limits(config):
+    """
+    Read the cardinality limits from the bucket sections of the config file,
+    as read by load_config, e.g.
+
+        [bucket:stats]
+        limits = user:1000 content:5000
+        overflow = other
+        limits_window = 86400
+
+    Limits are given as DIMENSION:COUNT, overflow is 'other' (the default)
+    or 'drop'. The window is how many seconds values stay admitted for,
+    default a day, 0 for ever. Returns a dictionary suitable for
+    CardinalityGuard.
+    """
+    limits = {}
+    for bucket, options in config.buckets.items():
+        if 'limits' not in options:
+            continue
+        action = options.get('overflow', 'other').strip()
+        if action not in OVERFLOW_ACTIONS:
+            raise ValueError("Overflow in [bucket:%s] must be 'other' or 'drop'" % (bucket,))
+        window = options.get('limits_window', str(DEFAULT_WINDOW)).strip()
+        if not window.isdigit():
+            raise ValueError("Limits window in [bucket:%s] must be a number of seconds" % (bucket,))
+        for spec in re.split(r'[\s,]+', options['limits'].strip()):
+            name, _, count = spec.partition(':')
+            if not count.isdigit():
+                raise ValueError("Limit of '%s' in [bucket:%s] must be a number" % (name, bucket))
+            limits[(bucket, name)] = (int(count), action, int(window))
+    return limits
@@ -28,19 +28,155 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 __all__ = ['main']
 
-from hyperstats.connection import redis_connect, hyperdex_connect
-from hyperstats.common import to_utf8_str, unixtime, split_facet
-import logging, json, bottle, marshal
+from hyperstats.connection import Connections
+from hyperstats.config import load_config
+from hyperstats.common import to_utf8_str, unixtime, split_facet, facet_levels, flatten_facet, make_facet_id, ValidationError, shard_parent_id, SHARDS_VALUE
+from hyperstats.schema import load_schemas
+from hyperstats.guard import guard_status
+from hyperstats.sketch import count_hll, merge_hll, DDSketch, quantile_name, topk_key, load_topk, TOPK_SIZE
+from hyperstats.spool import Spool, SpoolForwarder, SpoolFull
+from hyperstats.prefork import PreforkServer
+from redis import RedisError
+from random import random
+import logging, json, bottle, gevent, marshal, hyperclient, math, argparse, sys, socket, os
 
 LOG = logging.getLogger(__name__)
-RDB = redis_connect()
-HDEX = hyperdex_connect()
+DEFAULT_QUANTILES = [0.5, 0.95, 0.99]
+RANGE_OPS = ['sum', 'min', 'max', 'avg']
+# Children fetched at a time when aggregating a range
+RANGE_PAGE_SIZE = 100
+# Connections are only made when first used
+DB = Connections()
+
+class QueueMonitor(object):
+    """
+    Admission control for the sink, based on the length of the aggregator
+    queue. Records are refused once the queue reaches the high watermark,
+    and accepted again once it has drained to the low watermark.
+
+    The length is only asked for with LLEN every `interval` seconds, in
+    between the records pushed by this process are added to it. While Redis
+    can't be reached the last estimate is used, so records can still be
+    spooled.
+    """
+    def __init__(self, queue_name, high_watermark=0, low_watermark=0,
+                 interval=0.5, retry_after=1):
+        """
+        :param high_watermark: Queue length to start refusing records at,
+                               0 disables admission control
+        :param retry_after: Seconds clients are told to wait when refused
+        """
+        self.queue_name = queue_name
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark or high_watermark, high_watermark)
+        self.interval = interval
+        self.retry_after = retry_after
+        self._length = 0
+        self._checked = None
+        self._overloaded = False
+
+    def length(self, rdb):
+        """
+        Estimated length of the queue
+        """
+        now = unixtime()
+        if self._checked is None or now - self._checked > self.interval:
+            self._checked = now
+            try:
+                self._length = rdb.llen(self.queue_name)
+            except RedisError, oops:
+                LOG.warning("Cannot get the queue length, using the last estimate: %s", oops)
+        return self._length
+
+    def pushed(self, count=1):
+        self._length += count
+
+    def admit(self, rdb):
+        """
+        Can another record be accepted?
+        """
+        if not self.high_watermark:
+            return True
+        length = self.length(rdb)
+        if self._overloaded:
+            if length <= self.low_watermark:
+                self._overloaded = False
+                LOG.warning("Queue drained to %d, accepting records", length)
+        elif length >= self.high_watermark:
+            self._overloaded = True
+            LOG.warning("Queue length %d above watermark, refusing records", length)
+        return not self._overloaded
+
+
+
+def random_round(number):
+    """
+    Rounds to one of the two nearest integers, with probabilities such that
+    the expected result is the number itself.
+    """
+    whole = math.floor(number)
+    return int(whole) + (1 if random() < (number - whole) else 0)
+
 
-class ValidationError(Exception):
+class Sampler(object):
     """
-    Data the user provided isn't sane.
+    Adaptive sampling of records when the aggregator queue is long. Once the
+    queue is longer than `start` only a fraction `start / length` of records
+    are kept, but no less than `min_rate`.
+
+    Kept values are scaled by 1/rate so sums stay unbiased. While sampling is
+    enabled every kept record, including those kept at a rate of 1, adds to
+    the reserved values of its facets:
+
+     - $hs.kept: Number of records kept
+     - $hs.weight: Number of records they represent, sum of 1/rate
+     - $hs.var: Variance of $hs.weight, sum of (1-rate)/rate^2
+
+    Which are reported by queries as the effective sampling rate and the
+    standard error. Records from before sampling was enabled aren't counted
+    by either, so the rate only covers the records since then. Distinct counts and quantiles aren't scaled, quantiles
+    stay unbiased but distinct counts will be under-estimated.
     """
-    pass
+    def __init__(self, start=0, min_rate=0.01):
+        """
+        :param start: Queue length to start sampling at, 0 disables sampling
+        """
+        self.start = start
+        self.min_rate = min_rate
+
+    def rate(self, length):
+        """
+        Fraction of records to keep at the given queue length
+        """
+        if not self.start or length <= self.start:
+            return 1.0
+        return max(self.min_rate, float(self.start) / length)
+
+    def keep(self, rate):
+        return rate >= 1.0 or random() < rate
+
+    def weighted(self, record, rate):
+        """
+        Scale the values of a kept record
+        """
+        if rate >= 1.0:
+            values = record['values'] + [('$hs.kept', 1), ('$hs.weight', 1)]
+        else:
+            values = [(name, random_round(value / rate)) for name, value in record['values']]
+            values += [('$hs.kept', 1),
+                       ('$hs.weight', random_round(1.0 / rate)),
+                       ('$hs.var', random_round((1.0 - rate) / (rate * rate)))]
+        record['values'] = sorted(values, key=lambda x: x[0])
+        return record
+
+QUEUE = QueueMonitor('aggqueue')
+SAMPLER = Sampler()
+# Optional local disk spool which records are written to instead of Redis
+SPOOL = None
+# Compiled schemas of the buckets which declare one, by bucket name
+SCHEMAS = {}
+# Names of the values with a top-K index, by bucket name
+TOPK = {}
 
 
 def sanitized_facets(input_facets):
@@ -87,6 +223,8 @@ def sanitized_values(input_values):
     for value_name, value in input_values.items():
         if type(value_name) not in [str, unicode]:
             raise ValidationError("Value names must be strings")        
+        if value_name.startswith('$'):
+            raise ValidationError("Value names cannot start with '$'")
         if type(value) != int:
             raise ValidationError("Value '%s' must be an integer" % (value_name,))
         values.append((to_utf8_str(value_name), int(value)))
@@ -94,6 +232,77 @@ def sanitized_values(input_values):
     return sorted(values, key=lambda x: x[0])
 
 
+def sanitized_distinct(input_distinct):
+    """
+    Sanitize the items to be counted distinctly, it must be a dictionary of
+    scalar values or lists of scalar values.
+
+        e.g. {'users': 'bob', 'issues': [123, 456]}
+    """
+    if type(input_distinct) != dict:
+        raise ValidationError('"distinct" must be dictionary')
+
+    distinct = []
+    for name, items in input_distinct.items():
+        if type(name) not in [str, unicode]:
+            raise ValidationError("Distinct names must be strings")
+        if name.startswith('$'):
+            raise ValidationError("Distinct names cannot start with '$'")
+        if type(items) in [str, unicode, int, float]:
+            items = [items]
+        if type(items) not in [list, set] or len(items) == 0:
+            raise ValidationError("Distinct items for '%s' must be a string, int or float"
+                                  " - or a list containing only strings, ints and floats" % (name,))
+        for item in items:
+            if type(item) not in [int, str, unicode, float]:
+                raise ValidationError("Distinct items for '%s' must be a string, int or float" % (name,))
+        distinct.append((to_utf8_str(name), [to_utf8_str(item) for item in items]))
+
+    return sorted(distinct, key=lambda x: x[0])
+
+
+def sanitized_samples(input_samples):
+    """
+    Sanitize the samples to add to quantile sketches, it must be a dictionary
+    of numbers or lists of numbers.
+
+        e.g. {'view_duration': 123.4, 'load_time': [12, 18]}
+    """
+    if type(input_samples) != dict:
+        raise ValidationError('"samples" must be dictionary')
+
+    samples = []
+    for name, numbers in input_samples.items():
+        if type(name) not in [str, unicode]:
+            raise ValidationError("Sample names must be strings")
+        if name.startswith('$'):
+            raise ValidationError("Sample names cannot start with '$'")
+        if type(numbers) in [int, float]:
+            numbers = [numbers]
+        if type(numbers) != list or len(numbers) == 0:
+            raise ValidationError("Samples for '%s' must be a number or a list of numbers" % (name,))
+        for number in numbers:
+            if type(number) not in [int, float] or math.isinf(number) or math.isnan(number):
+                raise ValidationError("Samples for '%s' must be finite numbers" % (name,))
+        samples.append((to_utf8_str(name), numbers))
+
+    return sorted(samples, key=lambda x: x[0])
+
+
+def sanitized_quantiles(input_quantiles):
+    """
+    Sanitize the list of quantiles requested, numbers between 0 and 1
+    """
+    if input_quantiles is None:
+        return DEFAULT_QUANTILES
+    if type(input_quantiles) != list:
+        raise ValidationError('"quantiles" must be a list')
+    for quantile in input_quantiles:
+        if type(quantile) not in [int, float] or not (0 <= quantile <= 1):
+            raise ValidationError('Quantiles must be numbers between 0 and 1')
+    return input_quantiles
+
+
 def make_record(data):
     """
     Make a record to be inserted into a bucket
@@ -110,19 +319,76 @@ def make_record(data):
     record_id = to_utf8_str(data['id'])
     facets = sanitized_facets(data['facets'])
     values = sanitized_values(data['values'])    
+    distinct = sanitized_distinct(data.get('distinct', {}))
+    samples = sanitized_samples(data.get('samples', {}))
+
+    names = [name for name, _ in values + distinct + samples]
+    if len(set(names)) != len(names):
+        raise ValidationError('Names of values, distinct and samples must be unique')
 
     return {
         'id': record_id,
         'facets': facets,
         'values': values,
+        'distinct': distinct,
+        'samples': samples,
     }
 
+def merge_shards(bucket, facet_id, data):
+    """
+    The record of a hot facet only has part of its counters, the rest are
+    split across its shards. Returns the record with them all added up.
+    """
+    values = dict(data['values'])
+    if SHARDS_VALUE not in values:
+        return data
+    del values[SHARDS_VALUE]
+    distinct = dict(data.get('distinct') or {})
+    quantiles = dict(data.get('quantiles') or {})
+    for shard in DB.hyperdex.search(bucket, {'facet_parent_id': shard_parent_id(facet_id)}):
+        for name, value in shard['values'].items():
+            values[name] = values.get(name, 0) + value
+        for name, sketch in (shard.get('distinct') or {}).items():
+            distinct[name] = merge_hll(DB.redis, [distinct.get(name), sketch])
+        for name, dumped in (shard.get('quantiles') or {}).items():
+            sketch = DDSketch.loads(dumped)
+            if name in quantiles:
+                sketch.merge(DDSketch.loads(quantiles[name]))
+            quantiles[name] = sketch.dumps()
+    merged = dict(data)
+    merged.update(values=values, distinct=distinct, quantiles=quantiles)
+    return merged
+
+def result_values(data, quantiles=None):
+    """
+    The values of a facet retrieved from HyperDex, including the estimated
+    counts of distinct items and the requested quantiles of samples.
+    """
+    values = dict(data['values'])
+    values.update(count_hll(DB.redis, data.get('distinct') or {}))
+    if '$hs.weight' in values:
+        kept = values.pop('$hs.kept')
+        weight = values.pop('$hs.weight')
+        values['$sampling'] = {
+            'kept': kept,
+            'estimated': weight,
+            'rate': (float(kept) / weight) if weight else 1.0,
+            'stderr': math.sqrt(max(0, values.pop('$hs.var', 0)))
+        }
+    for name, dumped in (data.get('quantiles') or {}).items():
+        sketch = DDSketch.loads(dumped)
+        result = {'count': sketch.count}
+        for quantile in (quantiles or DEFAULT_QUANTILES):
+            result[quantile_name(quantile)] = sketch.quantile(quantile)
+        values[name] = result
+    return values
+
 def handle_error(httperror):
     response = bottle.response
     response.set_header('content-type', 'application/json')
     return json.dumps({'ok': False,
                        'status': httperror.status,
-                       'msg': httperror.output})
+                       'msg': httperror.body})
 
 @bottle.error(code=500)
 def handle_error500(httperror):
@@ -132,6 +398,25 @@ def handle_error500(httperror):
 def handle_error400(httperror):
     return handle_error(httperror)
 
+@bottle.error(code=503)
+def handle_error503(httperror):
+    return handle_error(httperror)
+
+@bottle.route('/_status', method=['GET'], name='status')
+def status():
+    """
+    Connection pool statistics, the estimated queue length and the
+    dimensions which have gone over their cardinality limits. When pool
+    waits are frequent or long, the pools are too small.
+    """
+    return {
+        'ok': True,
+        'status': 200,
+        'pools': DB.stats(),
+        'queue': QUEUE.length(DB.redis),
+        'cardinality': guard_status(DB.redis)
+    }
+
 @bottle.route('/<bucket:re:[a-z]+>/find-values', method=['POST'], name='find_values')
 def find_values(bucket):
     """
@@ -146,6 +431,16 @@ def find_values(bucket):
                             'limit': 50}
         }
 
+    With 'withvalues' the values of each sub-facet are returned, samples are
+    summarized by the 'quantiles' given in the search (default p50, p95, p99).
+
+    With 'order_by' set to the name of a value, the sub-facets with the
+    highest totals for it are returned in descending order, at most 100.
+    The value must be configured to have a top-K index (see load_topk),
+    which the aggregator maintains so the time taken
+    doesn't depend on how many sub-facets there are. The results are then a
+    list, of [facet, values] pairs when 'withvalues' is set.
+
     On success it will return the a standard API response including the
     'results' key which contains a 
 
@@ -180,6 +475,10 @@ def find_values(bucket):
             bottle.abort(400, 'Invalid "limit" for "%s"' % (name,))
 
         withvalues = bool(search.get('withvalues'))
+        try:
+            quantiles = sanitized_quantiles(search.get('quantiles'))
+        except ValidationError, oops:
+            bottle.abort(400, "%s: %s" % (name, oops.message))
 
         startkey = None
         if 'startkey' in search:
@@ -193,16 +492,32 @@ def find_values(bucket):
         except ValidationError, oops:
             LOG.info("'%s' contained invalid facet", name, exc_info=True)
             bottle.abort(400, "%s: %s" % (name, oops.message))
+        order_by = search.get('order_by')
+        if order_by is not None:
+            if type(order_by) not in [str, unicode]:
+                bottle.abort(400, 'Invalid "order_by" for "%s"' % (name,))
+            if startkey is not None:
+                bottle.abort(400, '"startkey" cannot be used with "order_by" for "%s"' % (name,))
+            order_by = to_utf8_str(order_by)
+            if order_by not in TOPK.get(bucket, ()):
+                bottle.abort(400, 'No top-K index of "%s" for "%s"' % (order_by, name))
+
         searches[name] = {
-            'facet': split_facet(facet),
+            'levels': facet_levels(facet),
+            'order_by': order_by,
+            'facet': split_facet(facet_levels(facet)),
             'limit': limit,
-            'startkey': start,
-            'withvalues': withvalues
+            'startkey': startkey,
+            'withvalues': withvalues,
+            'quantiles': quantiles
         }
 
     # Perform searches    
     all_results = {}
     for name, search in searches.items():
+        if search['order_by'] is not None:
+            all_results[name] = find_top_values(bucket, search)
+            continue
         predicate = {
             'facet_parent_id': search['facet']['parent_id'],            
         }
@@ -214,13 +529,14 @@ def find_values(bucket):
             limit += 1
         withvalues = search['withvalues']
         results = {} if withvalues else []
-        searchiter = HDEX.sorted_search(bucket, predicate, 'facet', limit, 'min')
+        searchiter = DB.hyperdex.sorted_search(bucket, predicate, 'facet', limit, 'min')
         for result in searchiter:
             facet = result['facet']
             if facet == startkey:
                 continue
             if withvalues:
-                results[facet] = result['values']
+                result = merge_shards(bucket, result['id'], result)
+                results[facet] = result_values(result, search['quantiles'])
             else:
                 results.append(facet)
         all_results[name] = results
@@ -230,11 +546,36 @@ def find_values(bucket):
     return {
         'ok': True,
         'status': 200,
-        'results': results,
+        'results': all_results,
         'time': end_time - start_time
     }
 
 
+def find_top_values(bucket, search):
+    """
+    The sub-facets with the highest totals of the 'order_by' value, from the
+    top-K index maintained by the aggregator.
+    """
+    key = topk_key(search['facet']['parent_id'], search['order_by'])
+    limit = min(search['limit'], TOPK_SIZE)
+    # An end of -1 would be the whole index
+    if limit < 1:
+        return []
+    children = DB.redis.zrevrange(key, 0, limit - 1)
+    if not search['withvalues']:
+        return children
+
+    parent = flatten_facet(search['levels'])[:-1]
+    results = []
+    for child in children:
+        facet_id = make_facet_id(parent + [child])
+        data = DB.hyperdex.get(bucket, facet_id)
+        if data is not None:
+            data = merge_shards(bucket, facet_id, data)
+            results.append([child, result_values(data, search['quantiles'])])
+    return results
+
+
 @bottle.route('/<bucket:re:[a-z]+>/get-values', method=['POST'], name='get_values')
 def get_values(bucket):
     """
@@ -268,6 +609,14 @@ def get_values(bucket):
         }
 
     This allows effecient retrieve of any number of facet values from  the DB.
+
+    Samples are summarized as their count and the p50, p95 and p99 quantiles,
+    other quantiles can be requested by giving the facet and a list of them:
+
+        {
+            'tablet-dayone': {'facet': {'device': ['tablet', 'apple']},
+                              'quantiles': [0.5, 0.999]}
+        }
     """
     start_time = unixtime()
     request = bottle.request
@@ -277,24 +626,33 @@ def get_values(bucket):
         bottle.abort(400, 'Must POST application/json dictionary')
 
     facet_keys = {}
+    key_quantiles = {}
     results = {}
 
     # Prepare facets for query
     for key, facet in query.items():
         try:
-            facet = sanitized_facets(query['facets'])
+            # Facet values are never dictionaries, so this is unambiguous
+            quantiles = None
+            if type(facet) == dict and type(facet.get('facet')) == dict:
+                quantiles = facet.get('quantiles')
+                facet = facet['facet']
+            key_quantiles[key] = sanitized_quantiles(quantiles)
+            facet = sanitized_facets(facet)
         except ValidationError, oops:
             LOG.info("Query for '%s' contained invalid facet", key, exc_info=True)
             bottle.abort(400, "%s: %s" % (key, oops.message))
-        facet_keys[key] = split_facet(facet)    
+        facet_keys[key] = split_facet(facet_levels(facet))
 
     # Retrieve values from databases
     try:
         for key, facet_key in facet_keys.items():
-            data = HDEX.get(bucket, facet_key['id'])
+            data = DB.hyperdex.get(bucket, facet_key['id'])
             if data is None:
                 results[key] = None
-            results[key] = data['values']
+            else:
+                data = merge_shards(bucket, facet_key['id'], data)
+                results[key] = result_values(data, key_quantiles[key])
     except Exception:
         LOG.error('Failed to retrieve facets', exc_info=True)
         bottle.abort(500, 'Could not retrieve facets')
@@ -308,29 +666,243 @@ def get_values(bucket):
         'time': end_time - start_time
     }
 
+def range_bound(bound):
+    """
+    Numeric range bounds are kept as numbers, others as strings
+    """
+    if bound is None or type(bound) in [int, float]:
+        return bound
+    return to_utf8_str(bound)
+
+def range_children(bucket, parent_id, start=None, end=None):
+    """
+    The children of a parent facet between start and end inclusive, fetched
+    from sorted_search a page at a time.
+
+    Children are stored as strings, so string bounds are compared by HyperDex
+    while numeric bounds are compared after parsing the children as numbers,
+    skipping the ones which aren't.
+    """
+    numeric = type(start) in [int, float] or type(end) in [int, float]
+    after = None
+    while True:
+        lower = after
+        if lower is None and not numeric:
+            lower = start
+        upper = None if numeric else end
+        predicate = {'facet_parent_id': parent_id}
+        if lower is not None and upper is not None:
+            predicate['facet'] = hyperclient.Range(lower, upper)
+        elif lower is not None:
+            predicate['facet'] = hyperclient.GreaterEqual(lower)
+        elif upper is not None:
+            predicate['facet'] = hyperclient.LessEqual(upper)
+        page = DB.hyperdex.sorted_search(bucket, predicate, 'facet', RANGE_PAGE_SIZE, 'min')
+        for result in page:
+            child = result['facet']
+            if child == after:
+                continue
+            if numeric:
+                try:
+                    number = float(child)
+                except ValueError:
+                    continue
+                if (start is not None and number < start) or (end is not None and number > end):
+                    continue
+            yield result
+        if len(page) < RANGE_PAGE_SIZE:
+            return
+        after = page[-1]['facet']
+
+def aggregate_values(results, names, ops):
+    """
+    Combine the values of many facets with the operations, names being None
+    means all the values found.
+    """
+    count = 0
+    totals = {}
+    for result in results:
+        count += 1
+        for name, value in result['values'].items():
+            if name.startswith('$') or (names is not None and name not in names):
+                continue
+            total = totals.get(name)
+            if total is None:
+                totals[name] = [value, value, value, 1]
+            else:
+                total[0] += value
+                total[1] = min(total[1], value)
+                total[2] = max(total[2], value)
+                total[3] += 1
+    values = {}
+    for name, (value_sum, value_min, value_max, value_count) in totals.items():
+        combined = {'sum': value_sum, 'min': value_min, 'max': value_max,
+                    'avg': float(value_sum) / value_count}
+        values[name] = dict((op, combined[op]) for op in ops)
+    return {'count': count, 'values': values}
+
+@bottle.route('/<bucket:re:[a-z]+>/aggregate-range', method=['POST'], name='aggregate_range')
+def aggregate_range(bucket):
+    """
+    Combines the values of a range of children of a parent facet, e.g. the
+    revenue of the first 15 days of a month.
+
+    It accepts a JSON dictionary of query names to the parent facet, the
+    'start' and 'end' children (inclusive, either may be left out), the
+    names of the 'values' to combine (default all) and the operations to
+    combine them with, any of 'sum' (the default), 'min', 'max' and 'avg':
+
+        {
+            'first-half': {'facet': {'time': ['2013', '1']},
+                           'start': 1, 'end': 15,
+                           'values': ['revenue'],
+                           'ops': ['sum', 'avg']}
+        }
+
+    When start or end are numbers the children are compared as numbers,
+    otherwise as strings. The average is over the children which have the
+    value. On success the results have the number of children in the range
+    and the combined values:
+
+        {
+            'ok': true,
+            'status': 200,
+            'results': {
+                'first-half': {'count': 15,
+                               'values': {'revenue': {'sum': 29382,
+                                                      'avg': 1958.8}}}
+            }
+        }
+    """
+    start_time = unixtime()
+    request = bottle.request
+    query = request.json
+
+    if query is None or type(query) != dict:
+        bottle.abort(400, 'Must POST application/json dictionary')
+
+    # Validate the queries
+    queries = {}
+    for name, search in query.items():
+        if type(search) != dict or 'facet' not in search:
+            bottle.abort(400, '"facet" key required for "%s"' % (name,))
+        try:
+            facet = sanitized_facets(search['facet'])
+            start = range_bound(search.get('start'))
+            end = range_bound(search.get('end'))
+        except ValidationError, oops:
+            LOG.info("'%s' contained invalid facet", name, exc_info=True)
+            bottle.abort(400, "%s: %s" % (name, oops.message))
+        except TypeError:
+            bottle.abort(400, 'Invalid "start" or "end" for "%s"' % (name,))
+        if None not in (start, end) and (type(start) == str) != (type(end) == str):
+            bottle.abort(400, '"start" and "end" for "%s" must both be numbers or strings' % (name,))
+
+        names = search.get('values')
+        if names is not None:
+            if type(names) != list or not all(type(x) in [str, unicode] for x in names):
+                bottle.abort(400, '"values" for "%s" must be a list of names' % (name,))
+            names = set(to_utf8_str(x) for x in names)
+        ops = search.get('ops', ['sum'])
+        if type(ops) != list or not ops or not all(op in RANGE_OPS for op in ops):
+            bottle.abort(400, '"ops" for "%s" must be a list of %s' % (name, ', '.join(RANGE_OPS)))
+
+        queries[name] = {
+            'parent_id': make_facet_id(flatten_facet(facet_levels(facet))),
+            'start': start,
+            'end': end,
+            'names': names,
+            'ops': ops
+        }
+
+    results = {}
+    try:
+        for name, search in queries.items():
+            children = range_children(bucket, search['parent_id'],
+                                      search['start'], search['end'])
+            children = (merge_shards(bucket, child['id'], child) for child in children)
+            results[name] = aggregate_values(children, search['names'], search['ops'])
+    except Exception:
+        LOG.error('Failed to aggregate range', exc_info=True)
+        bottle.abort(500, 'Could not aggregate range')
+
+    end_time = unixtime()
+
+    return {
+        'ok': True,
+        'status': 200,
+        'results': results,
+        'time': end_time - start_time
+    }
+
+def overloaded():
+    """
+    Error telling the client to retry later
+    """
+    error = bottle.HTTPError(503, 'Overloaded, retry later')
+    error.set_header('Retry-After', str(QUEUE.retry_after))
+    return error
+
 @bottle.route('/<bucket:re:[a-z]+>', method=['POST', 'PUT'], name='sink')
 def sink(bucket):
     """
     Allows clients to submit records via HTTP
+
+    The record is a JSON dictionary with 'id', 'facets' and 'values' keys and
+    an optional 'distinct' dictionary of items to count distinctly per facet,
+    e.g. {'users': 'bob'}, and 'samples' of numbers to track the quantiles
+    of, e.g. {'view_duration': 12.5}.
+
+    When the aggregator has fallen too far behind, records are refused with a
+    503 response and a Retry-After header. Before that, records can be sampled
+    with the Sampler, the response then says if the record was 'kept'.
+
+    If the bucket has a schema, records are validated by it instead of the
+    generic checks, and refused unless they conform.
+
+    If there is a SPOOL the record is committed to local disk and forwarded
+    to the queue in the background, instead of pushing it to Redis directly.
     """
     start_time = unixtime()
+    if not QUEUE.admit(DB.redis):
+        raise overloaded()
+
     request = bottle.request
     data = request.json
 
+    schema = SCHEMAS.get(bucket)
     try:
-        record = make_record(data)
+        if schema is not None:
+            record = schema.make_record(data)
+        else:
+            record = make_record(data)
     except ValidationError, oops:
         LOG.info('Input data failed sanitization checks', exc_info=True)
         bottle.abort(400, oops.message)
     except Exception:
         LOG.error('Failed to create record', exc_info=True)
         bottle.abort(500, 'Could not pre-process data')
-
-    try:
-        RDB.rpush('aggqueue', marshal.dumps(record))        
-    except Exception:
-        LOG.error("Failed to insert data", exc_info=True)
-        bottle.abort(500, 'Server Error, data not inserted')
+    # The aggregator applies the bucket's cardinality limits
+    record['bucket'] = bucket
+
+    # The queue length is only needed when sampling
+    rate = SAMPLER.rate(QUEUE.length(DB.redis)) if SAMPLER.start else 1.0
+    kept = SAMPLER.keep(rate)
+    if kept:
+        if SAMPLER.start:
+            record = SAMPLER.weighted(record, rate)
+        try:
+            if SPOOL is not None:
+                SPOOL.wait(SPOOL.append(marshal.dumps(record)))
+            else:
+                DB.redis.rpush(QUEUE.queue_name, marshal.dumps(record))
+            QUEUE.pushed()
+        except SpoolFull:
+            LOG.warning("Spool is full, refusing records")
+            raise overloaded()
+        except Exception:
+            LOG.error("Failed to insert data", exc_info=True)
+            bottle.abort(500, 'Server Error, data not inserted')
 
     end_time = unixtime()
 
@@ -338,11 +910,98 @@ def sink(bucket):
         'ok': True,
         'status': 200,
         'id': record['id'],
+        'kept': kept,
         'time': end_time - start_time
     }
 
+def start_spool(directory, name):
+    """
+    Spool records in the directory, forwarding them in the background
+    """
+    global SPOOL
+    SPOOL = Spool(directory)
+    SpoolForwarder(SPOOL, DB.redis, QUEUE.queue_name, name).start()
+
+def adopt_spools(directory, name, active):
+    """
+    Forward the records left in spools which no worker uses any more, then
+    delete them. Prefork workers spool in 'worker-N' subdirectories and a
+    single process in the directory itself, so reducing --workers or
+    switching between the two leaves spools behind.
+
+    :param active: Directories of the spools which are in use
+    """
+    spools = [(directory, name)]
+    for entry in sorted(os.listdir(directory)):
+        if entry.startswith('worker-'):
+            spools.append((os.path.join(directory, entry),
+                           '%s:%s' % (name, entry[len('worker-'):])))
+    for path, spool_name in spools:
+        if path in active or not any(entry.endswith('.seg') for entry in os.listdir(path)):
+            continue
+        try:
+            spool = Spool(path)
+        except IOError:
+            LOG.info("Spool '%s' is in use, not adopting it", path)
+            continue
+        LOG.warning("Forwarding the records left in spool '%s'", path)
+        gevent.spawn(SpoolForwarder(spool, DB.redis, QUEUE.queue_name, spool_name).drain)
+
 def main(args):    
-    bottle.run(host='localhost', port=8080, server='gevent')
+    parser = argparse.ArgumentParser(prog='python -mhyperstats httpd')
+    parser.add_argument('--config',
+                        help='Config file with connection settings and bucket settings,'
+                             ' default $HYPERSTATS_CONFIG')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes sharing the port')
+    parser.add_argument('--drain-timeout', type=float, default=10,
+                        help='Seconds stopping workers may take to finish requests')
+    parser.add_argument('--queue-high', type=int, default=0,
+                        help='Refuse records when the queue is this long, default never')
+    parser.add_argument('--queue-low', type=int, default=0,
+                        help='Accept records again when the queue drains to this length')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Seconds refused clients should wait before retrying')
+    parser.add_argument('--sample-above', type=int, default=0,
+                        help='Sample records when the queue is longer than this, default never')
+    parser.add_argument('--sample-min-rate', type=float, default=0.01,
+                        help='Lowest fraction of records kept when sampling')
+    parser.add_argument('--spool',
+                        help='Directory to spool records in before forwarding them to Redis')
+    parser.add_argument('--spool-name',
+                        help='Unique name of the spool, default HOSTNAME:PORT')
+    opts = parser.parse_args(args)
+
+    DB.config = load_config(opts.config)
+    SCHEMAS.update(load_schemas(DB.config))
+    TOPK.update(load_topk(DB.config))
+    QUEUE.high_watermark = opts.queue_high
+    QUEUE.low_watermark = min(opts.queue_low or opts.queue_high, opts.queue_high)
+    QUEUE.retry_after = opts.retry_after
+    SAMPLER.start = opts.sample_above
+    SAMPLER.min_rate = opts.sample_min_rate
+    spool_name = opts.spool_name or '%s:%d' % (socket.gethostname(), opts.port)
+
+    if opts.workers > 1:
+        spools = [os.path.join(opts.spool or '', 'worker-%d' % (index,))
+                  for index in range(opts.workers)]
+        def setup(index):
+            # Every worker has its own connection pools and spool
+            DB.reset()
+            if opts.spool:
+                start_spool(spools[index], '%s:%d' % (spool_name, index))
+                if index == 0:
+                    adopt_spools(opts.spool, spool_name, spools)
+        PreforkServer(bottle.default_app(), opts.host, opts.port, opts.workers,
+                      setup, opts.drain_timeout).run()
+        return
+
+    if opts.spool:
+        start_spool(opts.spool, spool_name)
+        adopt_spools(opts.spool, spool_name, [opts.spool])
+    bottle.run(host=opts.host, port=opts.port, server='gevent')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(sys.argv[1:])
\ No newline at end of file
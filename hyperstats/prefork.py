@@ -0,0 +1,152 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['PreforkServer']
+
+import os, signal, socket, errno, time, logging
+
+LOG = logging.getLogger(__name__)
+
+# Not defined by the socket module of older Pythons, this is Linux's value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+class PreforkServer(object):
+    """
+    Runs a WSGI application in a number of forked gevent worker processes.
+
+    Each worker binds its own listening socket with SO_REUSEPORT so the kernel
+    balances connections between them, where that isn't supported the socket
+    is bound once before forking and shared. Workers which die are restarted,
+    on SIGTERM or SIGINT the workers are told to stop accepting connections
+    and finish the requests they're handling before exiting.
+    """
+    def __init__(self, app, host, port, workers, setup=None, drain_timeout=10,
+                 backlog=1024):
+        """
+        :param setup: Called in each worker with its index (0 to workers-1)
+                      before serving, e.g. to create connection pools
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.setup = setup
+        self.drain_timeout = drain_timeout
+        self.backlog = backlog
+        self._children = {}
+        self._stopping = False
+
+    def _bind(self, reuse_port):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        return listener
+
+    def _supports_reuse_port(self):
+        try:
+            probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            probe.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            probe.close()
+            return True
+        except (socket.error, OSError):
+            return False
+
+    def _worker(self, index, listener):
+        """
+        Body of a worker process, never returns
+        """
+        import gevent
+        from gevent.pywsgi import WSGIServer
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if listener is None:
+                listener = self._bind(True)
+            if self.setup is not None:
+                self.setup(index)
+            server = WSGIServer(listener, self.app, log=None)
+            # gevent.signal was renamed in gevent 1.5
+            handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+            handler(signal.SIGTERM, server.stop, self.drain_timeout)
+            server.serve_forever()
+        except Exception:
+            LOG.error("Worker %d failed", index, exc_info=True)
+            status = 1
+        os._exit(status)
+
+    def _spawn(self, index, listener):
+        pid = os.fork()
+        if pid == 0:
+            self._worker(index, listener)
+        self._children[pid] = (index, time.time())
+        LOG.info("Started worker %d, pid %d", index, pid)
+
+    def _stop(self, _sig, _frame=None):
+        """
+        Tell the workers to drain and exit
+        """
+        if not self._stopping:
+            LOG.info("Stopping %d workers", len(self._children))
+        self._stopping = True
+        for pid in self._children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        listener = None
+        if not self._supports_reuse_port():
+            LOG.warning("SO_REUSEPORT not supported, workers share one socket")
+            listener = self._bind(False)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._spawn(index, listener)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in self._children:
+                continue
+            index, started = self._children.pop(pid)
+            if self._stopping:
+                continue
+            LOG.warning("Worker %d (pid %d) exited with status %d, restarting",
+                        index, pid, status)
+            # Don't restart workers which die immediately in a tight loop
+            if time.time() - started < 1:
+                time.sleep(1)
+            self._spawn(index, listener)
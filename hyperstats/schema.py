@@ -0,0 +1,194 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['BucketSchema', 'load_schemas']
+
+from hyperstats.common import ValidationError
+import math, re
+
+KINDS = ['int', 'distinct', 'sample']
+
+# Same conversions as to_utf8_str, looked up by exact type so bools and
+# longs are refused like the generic checks do
+TO_UTF8 = {
+    str: lambda x: x,
+    unicode: lambda x: x.encode('utf-8', 'ignore'),
+    int: lambda x: "%d" % (x,),
+    float: lambda x: "%f" % (x,),
+}
+
+def _is_number(number):
+    return type(number) in (int, float) and not (math.isinf(number) or math.isnan(number))
+
+
+class BucketSchema(object):
+    """
+    Declares the dimensions a bucket's records are faceted by and the names
+    and types of their values, compiled into a validator which makes the same
+    records as httpd.make_record without the generic checks and sorting.
+
+    Conforming records have every dimension, each with exactly its declared
+    number of levels, and only declared values - all other records are
+    refused.
+    """
+    def __init__(self, bucket, dimensions, values):
+        """
+        :param dimensions: Dictionary of dimension names to their depth
+        :param values: Dictionary of value names to their kind, one of
+                       'int', 'distinct' or 'sample'
+        """
+        self.bucket = bucket
+        self.dimensions = dimensions
+        self.values = values
+        for name, depth in dimensions.items():
+            if type(depth) != int or depth < 1:
+                raise ValueError("Depth of dimension '%s' must be a positive integer" % (name,))
+        for name, kind in values.items():
+            if name.startswith('$'):
+                raise ValueError("Value names cannot start with '$'")
+            if kind not in KINDS:
+                raise ValueError("Value '%s' has unknown kind '%s'" % (name, kind))
+        # Pre-sorted, with the keys that names have in decoded JSON
+        self._dimensions = [(name, name.decode('utf-8'), depth)
+                            for name, depth in sorted(dimensions.items())]
+        self._kinds = {}
+        for kind in KINDS:
+            self._kinds[kind] = [(name, name.decode('utf-8'))
+                                 for name, value_kind in sorted(values.items())
+                                 if value_kind == kind]
+
+    def _facets(self, input_facets):
+        if type(input_facets) != dict or len(input_facets) != len(self._dimensions):
+            raise ValidationError('"facets" must have the dimensions %s' % (
+                                  ', '.join(name for name, _, _ in self._dimensions),))
+        facets = []
+        for name, key, depth in self._dimensions:
+            levels = input_facets.get(key)
+            if depth == 1 and type(levels) in TO_UTF8:
+                levels = [levels]
+            elif type(levels) != list or len(levels) != depth:
+                raise ValidationError("Facet '%s' must be a list of %d values" % (name, depth))
+            try:
+                facets.append((name, [TO_UTF8[type(level)](level) for level in levels]))
+            except KeyError:
+                raise ValidationError("Facet '%s' values must be strings, ints or floats" % (name,))
+        return facets
+
+    def _named(self, kind, section, inputs, check):
+        """
+        Declared entries of one kind, in name order, as (name, item) tuples
+        """
+        if type(inputs) != dict:
+            raise ValidationError('"%s" must be dictionary' % (section,))
+        result = []
+        for name, key in self._kinds[kind]:
+            if key in inputs:
+                result.append((name, check(name, inputs[key])))
+        if len(result) != len(inputs):
+            unknown = set(inputs) - set(key for _, key in self._kinds[kind])
+            raise ValidationError("Unknown %s for bucket '%s': %s" % (
+                                  section, self.bucket, ', '.join(sorted(unknown))))
+        return result
+
+    def _int(self, name, value):
+        if type(value) != int:
+            raise ValidationError("Value '%s' must be an integer" % (name,))
+        return value
+
+    def _distinct(self, name, items):
+        if type(items) in TO_UTF8:
+            items = [items]
+        elif type(items) != list or len(items) == 0:
+            raise ValidationError("Distinct items for '%s' must be a string, int or float"
+                                  " - or a list containing only strings, ints and floats" % (name,))
+        try:
+            return [TO_UTF8[type(item)](item) for item in items]
+        except KeyError:
+            raise ValidationError("Distinct items for '%s' must be a string, int or float" % (name,))
+
+    def _samples(self, name, numbers):
+        if _is_number(numbers):
+            return [numbers]
+        if type(numbers) != list or len(numbers) == 0 or not all(map(_is_number, numbers)):
+            raise ValidationError("Samples for '%s' must be finite numbers" % (name,))
+        return numbers
+
+    def make_record(self, data):
+        """
+        Make a record to be inserted into the bucket, the same as
+        httpd.make_record but refusing anything the schema doesn't declare.
+        """
+        if type(data) != dict or 'facets' not in data or 'values' not in data:
+            raise ValidationError('Data must be dictionary with "id", "facets" and "values" keys')
+        record_id = data.get('id')
+        if type(record_id) not in (int, str, unicode):
+            raise ValidationError('The "id" must be a string or int')
+        return {
+            'id': TO_UTF8[type(record_id)](record_id),
+            'facets': self._facets(data['facets']),
+            'values': self._named('int', 'values', data['values'], self._int),
+            'distinct': self._named('distinct', 'distinct', data.get('distinct', {}),
+                                    self._distinct),
+            'samples': self._named('sample', 'samples', data.get('samples', {}),
+                                   self._samples),
+        }
+
+
+def _split_list(text):
+    return [item for item in re.split(r'[\s,]+', text.strip()) if item]
+
+def load_schemas(config):
+    """
+    Make the bucket schemas from the bucket sections of the config file, as
+    read by load_config, e.g.
+
+        [bucket:stats]
+        dimensions = time:4 device:2 content:3
+        values = datapoints view_duration users:distinct load_time:sample
+
+    Dimensions are given as NAME:DEPTH, values as NAME or NAME:KIND where the
+    kind is 'int' (the default), 'distinct' or 'sample'.
+
+    Returns a dictionary of bucket names to compiled BucketSchema objects.
+    """
+    schemas = {}
+    for bucket, options in config.buckets.items():
+        if 'dimensions' not in options:
+            continue
+        dimensions = {}
+        for spec in _split_list(options['dimensions']):
+            name, _, depth = spec.partition(':')
+            if not depth.isdigit():
+                raise ValueError("Dimension '%s' in [bucket:%s] needs a depth" % (name, bucket))
+            dimensions[name] = int(depth)
+        values = {}
+        for spec in _split_list(options.get('values', '')):
+            name, _, kind = spec.partition(':')
+            values[name] = kind or 'int'
+        schemas[bucket] = BucketSchema(bucket, dimensions, values)
+    return schemas
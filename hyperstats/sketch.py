@@ -0,0 +1,278 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['hll_key', 'make_hll', 'make_hlls', 'merge_hll', 'count_hll', 'dd_key', 'DDSketch',
+           'quantile_name', 'topk_key', 'load_topk', 'TOPK_SIZE']
+
+from base64 import b64encode
+from os import urandom
+from math import log, ceil
+import marshal, re
+
+def hll_key(facet_id, name):
+    """
+    Redis key of the HyperLogLog buffering distinct items for a facet
+    """
+    return '%s$hll.%s' % (facet_id, name)
+
+def _temp_key():
+    return '$hs.tmp.' + b64encode(urandom(9))
+
+def make_hll(rdb, items):
+    """
+    Serialized HyperLogLog sketch of the items, using Redis to build it
+
+    :param rdb: StrictRedis instance
+    :param items: List of strings
+    :returns: Redis HyperLogLog string
+    """
+    return make_hlls(rdb, [items])[0]
+
+def make_hlls(rdb, item_lists):
+    """
+    Serialized HyperLogLog sketches of each list of items, built in one
+    round trip to Redis
+
+    :param rdb: StrictRedis instance
+    :param item_lists: List of lists of strings
+    :returns: List of Redis HyperLogLog strings
+    """
+    keys = [_temp_key() for _ in item_lists]
+    with rdb.pipeline(True) as pipe:
+        for key, items in zip(keys, item_lists):
+            pipe.pfadd(key, *items)
+            pipe.get(key)
+            pipe.delete(key)
+        return pipe.execute()[1::3]
+
+def merge_hll(rdb, sketches):
+    """
+    Merges serialized HyperLogLog sketches, using Redis to do the work. Empty
+    or missing (None) sketches are skipped.
+
+    :param rdb: StrictRedis instance
+    :param sketches: List of Redis HyperLogLog strings
+    :returns: Merged HyperLogLog string
+    """
+    sketches = [sketch for sketch in sketches if sketch]
+    if len(sketches) < 2:
+        return sketches[0] if sketches else None
+    keys = [_temp_key() for _ in sketches]
+    with rdb.pipeline(True) as pipe:
+        for key, sketch in zip(keys, sketches):
+            pipe.set(key, sketch)
+        pipe.pfmerge(keys[0], *keys)
+        pipe.get(keys[0])
+        pipe.delete(*keys)
+        return pipe.execute()[-2]
+
+def count_hll(rdb, sketches):
+    """
+    Estimated cardinality of each serialized HyperLogLog sketch
+
+    :param rdb: StrictRedis instance
+    :param sketches: Dictionary of name to Redis HyperLogLog string
+    :returns: Dictionary of name to estimated count
+    """
+    if not sketches:
+        return {}
+    names = sketches.keys()
+    keys = [_temp_key() for _ in names]
+    with rdb.pipeline(True) as pipe:
+        for name, key in zip(names, keys):
+            pipe.set(key, sketches[name])
+            pipe.pfcount(key)
+        pipe.delete(*keys)
+        results = pipe.execute()
+    return {name: int(count) for name, count in zip(names, results[1:-1:2])}
+
+
+TOPK_SIZE = 100
+
+def topk_key(parent_id, name):
+    """
+    Redis key of the sorted set indexing the children of a facet with the
+    highest totals for the named value, at most TOPK_SIZE are kept.
+    """
+    return '%s$topk.%s' % (parent_id, name)
+
+def load_topk(config):
+    """
+    The values with a top-K index in each bucket, from the bucket sections
+    of the config file as read by load_config, e.g.
+
+        [bucket:stats]
+        topk = datapoints revenue
+
+    Each indexed value costs a sorted set per parent facet in Redis, and two
+    Redis operations for every facet synced, so none are indexed unless
+    configured. Returns a dictionary of bucket names to sets of value names.
+    """
+    topk = {}
+    for bucket, options in config.buckets.items():
+        names = set(re.split(r'[\s,]+', options.get('topk', '').strip())) - set([''])
+        if names:
+            topk[bucket] = names
+    return topk
+
+def dd_key(facet_id, name):
+    """
+    Redis key of the hash buffering quantile sketch bins for a facet
+    """
+    return '%s$dd.%s' % (facet_id, name)
+
+def quantile_name(quantile):
+    """
+    Name of the result for a quantile, e.g. 0.5 is 'p50' and 0.999 'p99.9'
+    """
+    return 'p%g' % (quantile * 100,)
+
+
+class DDSketch(object):
+    """
+    Mergeable quantile sketch with relative error guarantees, from the paper
+    "DDSketch: A Fast and Fully-Mergeable Quantile Sketch with Relative-Error
+    Guarantees" by Masson, Rim and Lee.
+
+    Values are counted in logarithmically sized bins, so any quantile is
+    within `alpha` (1% by default) of the true value. Bins are named by
+    `bin_name()` so they can be buffered as Redis hash fields with HINCRBY.
+    When there are more than `max_bins` the bins of the smallest values are
+    collapsed, keeping memory bounded.
+    """
+    ALPHA = 0.01
+    MAX_BINS = 2048
+
+    def __init__(self, alpha=ALPHA, max_bins=MAX_BINS):
+        self.alpha = alpha
+        self.max_bins = max_bins
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = log(self._gamma)
+        self.zero = 0
+        self.positive = {}
+        self.negative = {}
+
+    @property
+    def count(self):
+        return self.zero + sum(self.positive.values()) + sum(self.negative.values())
+
+    def bin_name(self, value):
+        """
+        Name of the bin which the value is counted in
+        """
+        if value > 0:
+            return 'p%d' % (int(ceil(log(value) / self._log_gamma)),)
+        elif value < 0:
+            return 'n%d' % (int(ceil(log(-value) / self._log_gamma)),)
+        return 'z'
+
+    def add_bins(self, bins):
+        """
+        Add counts to the named bins
+
+        :param bins: Dictionary of bin name to count
+        """
+        for name, count in bins.items():
+            count = int(count)
+            if name == 'z':
+                self.zero += count
+                continue
+            target = self.positive if name[0] == 'p' else self.negative
+            index = int(name[1:])
+            target[index] = target.get(index, 0) + count
+        self._collapse()
+
+    def bins(self):
+        """
+        Dictionary of bin name to count, as taken by add_bins
+        """
+        bins = {}
+        if self.zero:
+            bins['z'] = self.zero
+        for prefix, source in [('p', self.positive), ('n', self.negative)]:
+            for index, count in source.items():
+                bins['%s%d' % (prefix, index)] = count
+        return bins
+
+    def add(self, value, count=1):
+        self.add_bins({self.bin_name(value): count})
+
+    def merge(self, other):
+        assert other.alpha == self.alpha
+        self.zero += other.zero
+        for target, source in [(self.positive, other.positive),
+                               (self.negative, other.negative)]:
+            for index, count in source.items():
+                target[index] = target.get(index, 0) + count
+        self._collapse()
+
+    def _collapse(self):
+        for bins in [self.positive, self.negative]:
+            if len(bins) <= self.max_bins:
+                continue
+            indexes = sorted(bins.keys())
+            excess = indexes[:len(indexes) - self.max_bins + 1]
+            bins[excess[-1]] += sum(bins.pop(index) for index in excess[:-1])
+
+    def _value(self, index):
+        return 2 * pow(self._gamma, index) / (self._gamma + 1)
+
+    def quantile(self, quantile):
+        """
+        Estimated value at the quantile (0 to 1), or None when empty
+        """
+        total = self.count
+        if total == 0:
+            return None
+        rank = quantile * (total - 1)
+        seen = 0
+        for index in sorted(self.negative.keys(), reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive.keys()):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive.keys()))
+
+    def dumps(self):
+        return marshal.dumps((1, self.alpha, self.max_bins, self.zero,
+                              self.positive, self.negative))
+
+    @classmethod
+    def loads(cls, data):
+        _version, alpha, max_bins, zero, positive, negative = marshal.loads(data)
+        sketch = cls(alpha, max_bins)
+        sketch.zero = zero
+        sketch.positive = positive
+        sketch.negative = negative
+        return sketch
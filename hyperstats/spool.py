@@ -0,0 +1,352 @@
+"""
+Copyright (c) 2013, G Roberts
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+      this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+      this list of conditions and the following disclaimer in the documentation
+      and/or other materials provided with the distribution.
+    * Neither the name of the project nor the names of its contributors
+      may be used to endorse or promote products derived from this software
+      without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['SpoolFull', 'Spool', 'SpoolForwarder']
+
+from zlib import crc32
+import os, mmap, struct, fcntl, logging
+import gevent, gevent.event
+
+LOG = logging.getLogger(__name__)
+
+# Each record is framed by its length and CRC32, a length of 0 marks the end
+# of the data in a segment
+FRAME = struct.Struct('<II')
+
+class SpoolFull(Exception):
+    """
+    Too much data is waiting to be forwarded, the record wasn't spooled.
+    """
+    pass
+
+
+class Spool(object):
+    """
+    Append-only log of records on local disk, split into fixed size segment
+    files which are memory mapped. Positions in the log are tuples of
+    (segment number, offset).
+
+    Writers append records and then wait until they are committed: the
+    first writer to arrive starts a commit which waits `commit_interval`
+    for other writers to join, then flushes all of them to disk with a
+    single msync (group commit). Only committed records are read.
+
+    Segments which have been completely forwarded are deleted. After a
+    crash the end of the last segment is found by checking the frames,
+    anything after a torn write is discarded.
+
+    Only one process may use a spool at a time, opening one which another
+    process has open raises IOError.
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 max_segments=16, commit_interval=0.002):
+        """
+        :param max_segments: Refuse records with SpoolFull when this many
+                             segments haven't been forwarded yet
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.commit_interval = commit_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = os.open(os.path.join(directory, 'lock'), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(self._lock)
+            raise IOError("Spool '%s' is used by another process" % (directory,))
+        self._maps = {}
+        segments = self._segments()
+        if not segments:
+            self._create(0)
+            segments = [0]
+        self._first_seq = segments[0]
+        self._write_seq = segments[-1]
+        self._write_pos = self._recover(self._write_seq)
+        self._committed = (self._write_seq, self._write_pos)
+        self._committing = False
+        self._commit_event = gevent.event.Event()
+        self._available = gevent.event.Event()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, '%016d.seg' % (seq,))
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.seg'))
+
+    def _create(self, seq):
+        handle = os.open(self._path(seq), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(handle, self.segment_size)
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+        handle = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+
+    def _map(self, seq):
+        if seq not in self._maps:
+            with open(self._path(seq), 'r+b') as handle:
+                self._maps[seq] = mmap.mmap(handle.fileno(), self.segment_size)
+        return self._maps[seq]
+
+    def _frame_at(self, seq, pos):
+        """
+        Returns the record at the position, or None at the end of the data
+        """
+        if pos + FRAME.size > self.segment_size:
+            return None
+        data_map = self._map(seq)
+        length, checksum = FRAME.unpack_from(data_map, pos)
+        end = pos + FRAME.size + length
+        if length == 0 or end > self.segment_size:
+            return None
+        data = data_map[pos + FRAME.size:end]
+        if crc32(data) & 0xffffffff != checksum:
+            return None
+        return data
+
+    def _recover(self, seq):
+        """
+        Finds where the valid data in a segment ends, and clears the rest
+        """
+        pos = 0
+        while True:
+            data = self._frame_at(seq, pos)
+            if data is None:
+                break
+            pos += FRAME.size + len(data)
+        data_map = self._map(seq)
+        if pos + FRAME.size <= self.segment_size:
+            data_map[pos:pos + FRAME.size] = FRAME.pack(0, 0)
+            data_map.flush()
+        return pos
+
+    def append(self, data):
+        """
+        Append a record, call wait() with the returned position to know when
+        it has been committed to disk.
+        """
+        size = FRAME.size + len(data)
+        if size + FRAME.size > self.segment_size:
+            raise ValueError("Record too large for spool")
+        if self._write_pos + size > self.segment_size:
+            if self._write_seq - self._first_seq + 1 >= self.max_segments:
+                raise SpoolFull()
+            self._write_seq += 1
+            self._write_pos = 0
+            self._create(self._write_seq)
+        pos = self._write_pos
+        self._map(self._write_seq)[pos:pos + size] = \
+            FRAME.pack(len(data), crc32(data) & 0xffffffff) + data
+        self._write_pos += size
+        if not self._committing:
+            self._committing = True
+            gevent.spawn(self._commit)
+        return (self._write_seq, self._write_pos)
+
+    def _commit(self):
+        gevent.sleep(self.commit_interval)
+        self._committing = False
+        position = (self._write_seq, self._write_pos)
+        threadpool = gevent.get_hub().threadpool
+        for seq in range(self._committed[0], position[0] + 1):
+            threadpool.apply(self._map(seq).flush)
+        self._committed = max(self._committed, position)
+        event, self._commit_event = self._commit_event, gevent.event.Event()
+        event.set()
+        self._available.set()
+
+    def wait(self, position):
+        """
+        Block until everything up to the position has been committed
+        """
+        while self._committed < position:
+            self._commit_event.wait()
+
+    def read(self, position, limit):
+        """
+        Read up to `limit` committed records starting at the position.
+
+        :returns: Tuple of (list of records, position after them)
+        """
+        seq, pos = position
+        records = []
+        while len(records) < limit and (seq, pos) < self._committed:
+            data = self._frame_at(seq, pos)
+            if data is None:
+                # End of a segment which the writer has moved on from
+                seq, pos = seq + 1, 0
+                continue
+            records.append(data)
+            pos += FRAME.size + len(data)
+        return records, (seq, pos)
+
+    def wait_available(self, timeout=None):
+        """
+        Block until more records are committed
+        """
+        self._available.wait(timeout)
+        self._available.clear()
+
+    def release(self, position):
+        """
+        Delete the segments before the position, they've been forwarded
+        """
+        while self._first_seq < min(position[0], self._write_seq):
+            seq = self._first_seq
+            if seq in self._maps:
+                self._maps.pop(seq).close()
+            if os.path.exists(self._path(seq)):
+                os.unlink(self._path(seq))
+            self._first_seq += 1
+
+    @property
+    def start(self):
+        return (self._first_seq, 0)
+
+    def load_position(self):
+        """
+        The position recorded by save_position(), or the start of the log
+        """
+        try:
+            with open(os.path.join(self.directory, 'position')) as handle:
+                seq, pos = handle.read().split()
+                return (int(seq), int(pos))
+        except (IOError, ValueError):
+            return self.start
+
+    def save_position(self, position):
+        path = os.path.join(self.directory, 'position')
+        with open(path + '.tmp', 'w') as handle:
+            handle.write('%d %d\n' % position)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(path + '.tmp', path)
+
+    def close(self):
+        for data_map in self._maps.values():
+            data_map.close()
+        self._maps = {}
+        if self._lock is not None:
+            os.close(self._lock)
+            self._lock = None
+
+    def remove(self):
+        """
+        Delete the spool's files once everything has been forwarded, and its
+        directory if nothing else is in it
+        """
+        for seq in self._segments():
+            os.unlink(self._path(seq))
+        for name in ['position', 'position.tmp', 'lock']:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.unlink(path)
+        self.close()
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+
+class SpoolForwarder(object):
+    """
+    Forwards spooled records to the Redis queue in large pipelined batches.
+
+    The position forwarded up to is SET in Redis in the same MULTI/EXEC as
+    the RPUSH of the records, so they either both happen or neither does.
+    After an error, or when starting, the position is read back from Redis
+    so no record is ever pushed twice. A copy is kept next to the spool in
+    case Redis loses its data.
+    """
+    def __init__(self, spool, rdb, queue_name, name, batch_size=1000):
+        """
+        :param name: Unique name of the spool, for its position in Redis
+        """
+        self._spool = spool
+        self._rdb = rdb
+        self._queue_name = queue_name
+        self._key = '$hs.spool.%s' % (name,)
+        self._batch_size = batch_size
+
+    def load_position(self):
+        position = self._spool.load_position()
+        stored = self._rdb.get(self._key)
+        if stored is not None:
+            seq, pos = stored.split()
+            position = max(position, (int(seq), int(pos)))
+        return max(position, self._spool.start)
+
+    def run(self, drain=False):
+        """
+        Forward records as they're committed
+
+        :param drain: Return once every record has been forwarded
+        """
+        position = None
+        while True:
+            try:
+                if position is None:
+                    position = self.load_position()
+                records, end = self._spool.read(position, self._batch_size)
+                if drain and not records:
+                    return
+                if records:
+                    with self._rdb.pipeline(True) as pipe:
+                        pipe.rpush(self._queue_name, *records)
+                        pipe.set(self._key, '%d %d' % end)
+                        pipe.execute()
+                if end != position:
+                    self._spool.save_position(end)
+                    self._spool.release(end)
+                    position = end
+                if len(records) < self._batch_size and not drain:
+                    self._spool.wait_available(1)
+            except Exception:
+                LOG.error("Failed to forward spooled records", exc_info=True)
+                position = None
+                gevent.sleep(1)
+
+    def start(self):
+        return gevent.spawn(self.run)
+
+    def drain(self):
+        """
+        Forward what's left in a spool nothing writes to any more, then
+        delete it. Its position in Redis is deleted first, so a new spool
+        with the same name starts from the beginning.
+        """
+        self.run(drain=True)
+        self._rdb.delete(self._key)
+        self._spool.remove()
@@ -0,0 +1,125 @@
+"""
+Hot facets split into shards, their totals as read back and in the top-K
+indexes. Run with `python -m unittest discover tests`.
+"""
+
+from hyperstats.aggregator import HOT_KEY
+from hyperstats.bench import MemoryHyperDex, QuietAggregator
+from hyperstats.common import split_facet, flatten_facet, facet_levels, shard_parent_id, SHARDS_VALUE
+from hyperstats.sketch import topk_key
+import unittest, random
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+MONTHS = ['1', '2', '3', '4', '5', '6']
+
+
+class FailingHyperDex(MemoryHyperDex):
+    """
+    Fails to write the reserved value of hot facets, until `failures` is 0
+    """
+    failures = 0
+
+    def _check(self, value):
+        if self.failures and SHARDS_VALUE in value.get('values', {}):
+            self.failures -= 1
+            raise RuntimeError("HyperDex is unavailable")
+
+    def put_if_not_exist(self, space, key, value):
+        self._check(value)
+        return super(FailingHyperDex, self).put_if_not_exist(space, key, value)
+
+    def cond_put(self, space, key, condition, value):
+        self._check(value)
+        return super(FailingHyperDex, self).cond_put(space, key, condition, value)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class TestHotFacets(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.hdex = FailingHyperDex()
+        random.seed(1)
+        self.expected = {}
+
+    def aggregator(self):
+        aggregator = QuietAggregator(self.redis, self.hdex, topk=['hits'])
+        aggregator.hot_sample = 1
+        aggregator.hot_window = 20
+        return aggregator
+
+    def records(self, count):
+        """
+        Records for a month of 2013, most of them for March, remembering the
+        expected totals of each month
+        """
+        for _ in range(count):
+            month = '3' if random.random() < 0.6 else random.choice(MONTHS)
+            hits = random.randint(1, 5)
+            self.expected[month] = self.expected.get(month, 0) + hits
+            yield {'id': 'x', 'facets': [('time', ['2013', month])],
+                   'values': [('hits', hits)]}
+
+    def month_id(self, month):
+        return split_facet(flatten_facet(facet_levels([('time', ['2013', month])])))
+
+    def total(self, month):
+        """
+        Total hits of the month, adding up its shards as the httpd does
+        """
+        facet = self.month_id(month)
+        record = self.hdex.get('stats', facet['id'])
+        total = record['values'].get('hits', 0)
+        if SHARDS_VALUE in record['values']:
+            for shard in self.hdex.search('stats', {'facet_parent_id': shard_parent_id(facet['id'])}):
+                total += shard['values'].get('hits', 0)
+        return total
+
+    def index(self):
+        parent_id = self.month_id('3')['parent_id']
+        return self.redis.zrevrange(topk_key(parent_id, 'hits'), 0, -1, withscores=True)
+
+    def run_aggregator(self, aggregator, count):
+        for record in self.records(count):
+            aggregator.process(record)
+        aggregator.sync_redis(force=True)
+
+    def check_totals(self):
+        for month, expected in self.expected.items():
+            self.assertEqual(self.total(month), expected)
+        index = self.index()
+        self.assertEqual(sorted(index, key=lambda item: -item[1]), index)
+        for month, score in index:
+            self.assertEqual(score, self.expected[month], "Score of month %s" % (month,))
+
+    def test_topk_scores_of_hot_facet(self):
+        first = self.aggregator()
+        # Not hot yet, so the base record is indexed with its total
+        self.run_aggregator(first, 10)
+        # Another aggregator which doesn't know it's hot yet
+        second = self.aggregator()
+        self.run_aggregator(first, 200)
+        self.assertIn(self.month_id('3')['id'], self.redis.smembers(HOT_KEY))
+        second.hot_window = 1000
+        for record in self.records(50):
+            second.aggregate_in_redis(record)
+        second.sync_redis(force=True)
+        self.run_aggregator(first, 100)
+        self.check_totals()
+
+    def test_marker_failure_is_retried(self):
+        aggregator = self.aggregator()
+        self.hdex.failures = 1
+        self.run_aggregator(aggregator, 30)
+        self.assertEqual(self.hdex.failures, 0)
+        self.run_aggregator(aggregator, 200)
+        self.assertIn(self.month_id('3')['id'], self.redis.smembers(HOT_KEY))
+        self.check_totals()
+
+
+if __name__ == '__main__':
+    unittest.main()
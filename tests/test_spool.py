@@ -0,0 +1,193 @@
+"""
+Crash recovery of the local disk spool, and forwarding its records to Redis
+exactly once. Run with `python -m unittest discover tests`.
+"""
+
+from hyperstats.spool import Spool, SpoolForwarder, FRAME
+import unittest, tempfile, shutil, os
+import gevent
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._spool = None
+
+    def tearDown(self):
+        if self._spool is not None:
+            self._spool.close()
+        shutil.rmtree(self.directory, True)
+
+    def spool(self):
+        """
+        Open the spool, closing it first if it's open, as if the process
+        using it had exited
+        """
+        if self._spool is not None:
+            self._spool.close()
+        self._spool = Spool(self.directory, segment_size=4096, max_segments=4,
+                            commit_interval=0)
+        return self._spool
+
+    def append(self, spool, records):
+        for data in records:
+            position = spool.append(data)
+        spool.wait(position)
+        return position
+
+
+class TestRecovery(SpoolTestCase):
+    def corrupt(self, offset):
+        """
+        Flip a byte of the first segment, as if the write there was torn
+        """
+        path = os.path.join(self.directory, '%016d.seg' % (0,))
+        with open(path, 'r+b') as handle:
+            handle.seek(offset)
+            byte = handle.read(1)
+            handle.seek(offset)
+            handle.write(chr(ord(byte) ^ 0xff))
+
+    def test_torn_write_is_discarded(self):
+        self.append(self.spool(), ['one', 'two', 'three'])
+        # Inside the data of the third record
+        self.corrupt(3 * FRAME.size + len('onetwo') + 1)
+
+        spool = self.spool()
+        records, _ = spool.read(spool.start, 10)
+        self.assertEqual(records, ['one', 'two'])
+
+        # New records go where the torn one was
+        self.append(spool, ['four'])
+        records, _ = spool.read(spool.start, 10)
+        self.assertEqual(records, ['one', 'two', 'four'])
+
+    def test_torn_frame_header_is_discarded(self):
+        self.append(self.spool(), ['one', 'two'])
+        # The length of the second record
+        self.corrupt(FRAME.size + len('one'))
+
+        spool = self.spool()
+        records, _ = spool.read(spool.start, 10)
+        self.assertEqual(records, ['one'])
+
+    def test_records_span_segments(self):
+        records = ['%04d' % (i,) * 100 for i in range(20)]
+        self.append(self.spool(), records)
+        spool = self.spool()
+        self.assertEqual(spool.read(spool.start, 100)[0], records)
+
+    def test_used_by_one_process(self):
+        self.spool()
+        self.assertRaises(IOError, Spool, self.directory)
+
+
+class FailingPipeline(object):
+    """
+    Applies the transaction, but raises as if the reply was lost
+    """
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __enter__(self):
+        self._pipe.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._pipe.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def execute(self):
+        self._pipe.execute()
+        raise IOError("Connection lost")
+
+
+class FlakyRedis(object):
+    """
+    Redis whose first transaction appears to fail after being applied
+    """
+    def __init__(self, rdb):
+        self._rdb = rdb
+        self.failures = 1
+
+    def __getattr__(self, name):
+        return getattr(self._rdb, name)
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._rdb.pipeline(*args, **kwargs)
+        if self.failures:
+            self.failures -= 1
+            return FailingPipeline(pipe)
+        return pipe
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class TestForwarder(SpoolTestCase):
+    def setUp(self):
+        super(TestForwarder, self).setUp()
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+
+    def forward(self, spool, rdb, expected):
+        """
+        Run a forwarder until the queue has `expected` records
+        """
+        forwarder = SpoolForwarder(spool, rdb, 'queue', 'test', batch_size=2)
+        greenlet = forwarder.start()
+        for _ in range(500):
+            if self.redis.llen('queue') >= expected:
+                break
+            gevent.sleep(0.01)
+        # Give it the chance to push anything more
+        gevent.sleep(0.05)
+        greenlet.kill()
+
+    def test_forwarded_once(self):
+        spool = self.spool()
+        self.append(spool, ['one', 'two', 'three'])
+        self.forward(spool, self.redis, 3)
+        self.assertEqual(self.redis.lrange('queue', 0, -1), ['one', 'two', 'three'])
+
+    def test_lost_reply_is_not_replayed(self):
+        spool = self.spool()
+        self.append(spool, ['one', 'two', 'three'])
+        # Forwarding is retried after the error, 1s later
+        self.forward(spool, FlakyRedis(self.redis), 4)
+        self.assertEqual(self.redis.lrange('queue', 0, -1), ['one', 'two', 'three'])
+
+    def test_restart_without_local_position(self):
+        spool = self.spool()
+        self.append(spool, ['one', 'two'])
+        self.forward(spool, self.redis, 2)
+        # As if it crashed after the push, before saving the position
+        os.unlink(os.path.join(self.directory, 'position'))
+
+        spool = self.spool()
+        self.append(spool, ['three'])
+        self.forward(spool, self.redis, 3)
+        self.assertEqual(self.redis.lrange('queue', 0, -1), ['one', 'two', 'three'])
+
+    def test_drain(self):
+        spool = self.spool()
+        self.append(spool, ['one', 'two', 'three'])
+        SpoolForwarder(spool, self.redis, 'queue', 'test', batch_size=2).drain()
+        self._spool = None
+        self.assertEqual(self.redis.lrange('queue', 0, -1), ['one', 'two', 'three'])
+        self.assertFalse(os.path.exists(self.directory))
+        # A new spool with the same name starts from the beginning
+        self.redis.delete('queue')
+        spool = self.spool()
+        self.append(spool, ['four'])
+        self.forward(spool, self.redis, 1)
+        self.assertEqual(self.redis.lrange('queue', 0, -1), ['four'])
+
+
+if __name__ == '__main__':
+    unittest.main()